@@ -19,6 +19,11 @@ class UDPChatClient:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.running = True
 
+        # 送信パケットの組み立てに使い回すバッファ
+        # (送信ごとの bytes 連結による中間オブジェクト生成を避ける)
+        self.send_buffer = bytearray(BUFFER_SIZE)
+        self.send_view = memoryview(self.send_buffer)
+
     def start(self):
         print(f"Connected to UDP chat server {self.server_address}")
         print("Type your message and press Enter to send.")
@@ -46,23 +51,30 @@ class UDPChatClient:
         """
         サーバからのメッセージを受信して表示する。
         """
+        # 受信用に使い回すバッファ (このスレッド専用)。
+        # recvfrom のように受信ごとに bytes を割り当てない
+        recv_buffer = bytearray(BUFFER_SIZE)
+        recv_view = memoryview(recv_buffer)
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(BUFFER_SIZE)
+                nbytes, _, _, addr = self.sock.recvmsg_into([recv_view], 0)
             except OSError:
                 break
 
-            if not data:
+            if nbytes == 0:
                 continue
 
-            # メッセージをパース
+            # メッセージをパース (次の受信で上書きされるので
+            # スライスの参照はこのイテレーション内でしか持たない)
+            data = recv_view[:nbytes]
             usernamelen = data[0]
             username_bytes = data[1: 1 + usernamelen]
-            message_bytes = data[1 + usernamelen:]
+            message_bytes = data[1 + usernamelen: nbytes]
 
             try:
-                from_username = username_bytes.decode('utf-8')
-                message = message_bytes.decode('utf-8')
+                # decode は新しい str を作るので memoryview を保持しない
+                from_username = username_bytes.tobytes().decode('utf-8')
+                message = message_bytes.tobytes().decode('utf-8')
             except UnicodeDecodeError:
                 continue
 
@@ -77,9 +89,24 @@ class UDPChatClient:
         message_encoded = message.encode('utf-8')
 
         usernamelen = len(username_encoded)
-        packet = bytes([usernamelen]) + username_encoded + message_encoded
-
-        self.sock.sendto(packet, self.server_address)
+        end = 1 + usernamelen + len(message_encoded)
+
+        if end > BUFFER_SIZE:
+            # バッファに収まらない場合のフォールバック。send_view が
+            # 生きている間 send_buffer はリサイズできない (BufferError)
+            # ので、素直に連結した bytes を送る
+            packet = bytes([usernamelen]) + username_encoded + message_encoded
+            self.sock.sendto(packet, self.server_address)
+            return
+
+        # 使い回しバッファに直接書き込んでパケットを組み立てる
+        buf = self.send_buffer
+        buf[0] = usernamelen
+        buf[1: 1 + usernamelen] = username_encoded
+        buf[1 + usernamelen: end] = message_encoded
+
+        # memoryview のスライスはコピーを作らない
+        self.sock.sendto(self.send_view[:end], self.server_address)
 
 
 if __name__ == "__main__":
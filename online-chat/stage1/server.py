@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import ctypes
+import ctypes.util
+import heapq
+import os
 import socket
+import struct
 import threading
 import time
 
@@ -10,13 +15,131 @@ HOST = '0.0.0.0'  # すべてのインターフェースで待受
 PORT = 50000      # 任意のポート番号
 BUFFER_SIZE = 4096
 CLIENT_TIMEOUT = 60  # 最終メッセージ受信から 60 秒経過で削除
+RECV_BATCH_SIZE = 32  # 1 回の起床でまとめて処理するデータグラム数の上限
+NUM_UDP_WORKERS = os.cpu_count() or 1  # UDP 受信ワーカー数 (= ソケット数)
+
+# ============================================================
+# sendmmsg(2) ラッパ
+# Python の socket モジュールには無いので libc を ctypes で直接呼ぶ。
+# 同じパケットを N 宛先へ送るとき、sendto を N 回呼ぶ代わりに
+# 1 回のシステムコールでまとめて送信できる。
+# ============================================================
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _HAS_SENDMMSG = hasattr(_libc, 'sendmmsg')
+except (OSError, TypeError):
+    _libc = None
+    _HAS_SENDMMSG = False
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def pack_sockaddr_in(addr):
+    """(ip, port) タプルを struct sockaddr_in のバイト列 (16 バイト) にする"""
+    ip, port = addr
+    return (struct.pack('=H', int(socket.AF_INET)) +
+            struct.pack('!H', port) +
+            socket.inet_aton(ip) +
+            bytes(8))
+
+
+def sendmmsg_to_all(sock, packet, addrs):
+    """
+    同じ packet を addrs の全宛先へ送信する。
+    sendmmsg(2) が使える環境では 1 回のシステムコールにまとめ、
+    使えない環境では sendto のループにフォールバックする。
+    addrs は他スレッドから追加/削除され得るため、呼び出し時点の
+    長さを上限としてインデックスで読む (スナップショットは作らない)。
+    """
+    n = len(addrs)
+    if n == 0:
+        return
+
+    if not _HAS_SENDMMSG:
+        for i in range(n):
+            try:
+                sock.sendto(packet, addrs[i])
+            except IndexError:
+                # 並行して削除されて短くなった
+                break
+            except OSError:
+                # ネットワーク障害などで送れなかった場合
+                pass
+        return
+
+    # ペイロードは全員共通なので iovec は 1 つを共有する
+    payload = ctypes.create_string_buffer(bytes(packet), len(packet))
+    iov = _IoVec(ctypes.cast(payload, ctypes.c_void_p), len(packet))
+
+    msgs = (_MMsgHdr * n)()
+    # sockaddr バッファが GC されないよう送信完了まで保持する
+    sockaddrs = []
+    for i in range(n):
+        try:
+            addr = addrs[i]
+        except IndexError:
+            # 並行して削除されて短くなった
+            n = i
+            break
+        sa = ctypes.create_string_buffer(pack_sockaddr_in(addr), 16)
+        sockaddrs.append(sa)
+        msgs[i].msg_hdr.msg_name = ctypes.cast(sa, ctypes.c_void_p)
+        msgs[i].msg_hdr.msg_namelen = 16
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iov)
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    if n == 0:
+        return
+
+    sent = 0
+    while sent < n:
+        r = _libc.sendmmsg(
+            sock.fileno(),
+            ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)),
+            n - sent, 0)
+        if r <= 0:
+            # 送信エラー時は残りを諦める (UDP なので再送しない)
+            break
+        sent += r
 
 
 class UDPChatServer:
     def __init__(self, host, port):
         self.server_address = (host, port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(self.server_address)
+
+        # SO_REUSEPORT で同じポートに複数ソケットを束ね、カーネルに
+        # フローを分散させる (1 ソケット = 1 受信ワーカースレッド)。
+        # SO_REUSEPORT が無い環境では従来どおり 1 ソケットで動く。
+        if NUM_UDP_WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            num_socks = NUM_UDP_WORKERS
+        else:
+            num_socks = 1
+
+        self.socks = []
+        for _ in range(num_socks):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if num_socks > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.server_address)
+            self.socks.append(sock)
 
         # クライアント情報を保存する辞書
         # key: (ip, port)
@@ -26,16 +149,31 @@ class UDPChatServer:
         # }
         self.clients = {}
 
+        # ブロードキャスト用の宛先配列。clients と並行して管理し、
+        # 追加は append、削除は末尾との swap-remove で O(1)。
+        # ブロードキャスト側は毎回 list(...) のスナップショットを
+        # 作らずにこの配列をそのまま読む。
+        self.client_addrs = []
+        # 配列と辞書の整合を守るための小さなロック (追加/削除時のみ保持)
+        self._registry_lock = threading.Lock()
+
+        # (期限, addr) の最小ヒープ。発言のたびに新しい期限を積み、
+        # 古いエントリは取り出すときに検証して捨てる (lazy deletion)。
+        # 全クライアントを定期的に走査する必要がなくなる。
+        self._expiry = []
+
         # 終了フラグ
         self.running = True
 
     def start(self):
-        print(f"UDP Chat Server started on {self.server_address} ...")
+        print(f"UDP Chat Server started on {self.server_address} "
+              f"with {len(self.socks)} worker(s) ...")
 
-        # 受信ループは別スレッドで動かす
-        receiver_thread = threading.Thread(
-            target=self.receive_loop, daemon=True)
-        receiver_thread.start()
+        # ソケットごとに受信スレッドを立てる
+        for sock in self.socks:
+            receiver_thread = threading.Thread(
+                target=self.receive_loop, args=(sock,), daemon=True)
+            receiver_thread.start()
 
         # クライアントを定期的に掃除するスレッド
         cleaner_thread = threading.Thread(
@@ -51,80 +189,139 @@ class UDPChatServer:
             print("\nShutting down server...")
 
         self.running = False
-        self.sock.close()
+        for sock in self.socks:
+            sock.close()
 
-    def receive_loop(self):
+    def receive_loop(self, sock):
         """
         クライアントからのメッセージを受信し、
         ほかのクライアントへブロードキャストする。
+        (ワーカースレッドごとに自分のソケットを 1 つ担当する)
+
+        1 データグラム = 1 システムコールにならないよう、最初の 1 個を
+        ブロッキング受信したあとはカーネルのキューに溜まっている分を
+        MSG_DONTWAIT でまとめて読み出す (recvmmsg 相当のバッチ処理)。
         """
+        # 受信用に使い回すバッファ (このスレッド専用)
+        buf = bytearray(BUFFER_SIZE)
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(BUFFER_SIZE)
+                # まず 1 個はブロッキングで待つ
+                nbytes, _, _, addr = sock.recvmsg_into([buf])
             except OSError:
                 # ソケットがクローズされるなどしてエラーになる可能性あり
                 break
 
-            if not data:
-                continue
+            self.handle_packet(bytes(buf[:nbytes]), addr, sock)
 
-            # メッセージからユーザー名と本文を取り出す
-            usernamelen = data[0]  # 最初の 1 バイト
-            username_bytes = data[1: 1 + usernamelen]
-            message_bytes = data[1 + usernamelen:]
+            # 続きが届いていれば同じ起床のうちに処理してしまう
+            for _ in range(RECV_BATCH_SIZE - 1):
+                try:
+                    nbytes, _, _, addr = sock.recvmsg_into(
+                        [buf], 0, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    # キューが空になった
+                    break
+                except OSError:
+                    return
+                self.handle_packet(bytes(buf[:nbytes]), addr, sock)
 
-            try:
-                username = username_bytes.decode('utf-8')
-                message = message_bytes.decode('utf-8')
-            except UnicodeDecodeError:
-                # デコード失敗した場合
-                continue
+    def handle_packet(self, data, addr, sock):
+        """
+        受信した 1 データグラムをパースしてブロードキャストする。
+        """
+        if not data:
+            return
+
+        # ユーザー名だけ取り出して decode する (クライアント登録用)。
+        # 本文はブロードキャストに str が不要なので decode しない。
+        usernamelen = data[0]  # 最初の 1 バイト
+        username_bytes = data[1: 1 + usernamelen]
 
-            # クライアントリストに登録 or 更新
-            self.clients[addr] = {
-                'username': username,
-                'last_active': time.time()
-            }
+        try:
+            username = username_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            # デコード失敗した場合
+            return
+
+        # クライアントリストに登録 or 更新
+        now = time.time()
+        info = self.clients.get(addr)
+        if info is not None:
+            info['username'] = username
+            info['last_active'] = now
+        else:
+            with self._registry_lock:
+                self.clients[addr] = {
+                    'username': username,
+                    'last_active': now,
+                    'arr_idx': len(self.client_addrs)
+                }
+                self.client_addrs.append(addr)
+        # heapq の sift は複数ステップの操作でスレッドセーフではない。
+        # 受信ワーカー (SO_REUSEPORT で複数) の push とクリーナーの pop が
+        # 競合するとヒープが壊れるため、レジストリと同じロックで守る
+        with self._registry_lock:
+            heapq.heappush(self._expiry, (now + CLIENT_TIMEOUT, addr))
 
-            # 受信メッセージをコンソールに表示（サーバ側ログ）
-            print(f"[{addr}] {username}: {message}")
+        # 受信メッセージをコンソールに表示（サーバ側ログ）
+        # 本文の decode はこのログ表示のためだけに行う
+        message = data[1 + usernamelen:].decode('utf-8', errors='replace')
+        print(f"[{addr}] {username}: {message}")
 
-            # 全クライアントにメッセージを転送
-            self.broadcast(username, message)
+        # 全クライアントにメッセージを転送
+        self.broadcast(data, sock)
 
-    def broadcast(self, username, message):
+    def broadcast(self, packet, sock):
         """
         現在登録されているすべてのクライアントに対し、メッセージを送信する。
+        受信パケットは配信パケットと同じレイアウト ([len][username][本文])
+        なので、再エンコードや組み立てをせずそのまま送る。
         """
-        # 送信用データにエンコード
-        username_encoded = username.encode('utf-8')
-        message_encoded = message.encode('utf-8')
-        usernamelen = len(username_encoded)
-
-        packet = bytes([usernamelen]) + username_encoded + message_encoded
-
-        # self.clients に格納されているアドレスすべてに送信
-        for addr in list(self.clients.keys()):
-            try:
-                self.sock.sendto(packet, addr)
-            except OSError:
-                # ネットワーク障害などで送れなかった場合
-                pass
+        # self.clients に格納されているアドレスすべてに 1 回のシステムコールで送信
+        # (宛先配列をそのまま渡し、スナップショットの list を作らない)
+        sendmmsg_to_all(sock, packet, self.client_addrs)
 
     def cleanup_inactive_clients_loop(self):
         """
-        定期的にクライアントの最終アクティブ時刻をチェックし、
-        一定時間経過したクライアントを削除する。
+        期限ヒープの先頭だけを見てタイムアウトしたクライアントを削除する。
+        全クライアントの走査は行わず、実際に期限が来たエントリの分しか
+        仕事をしない。
         """
         while self.running:
             now = time.time()
-            # タイムアウトしたクライアントは削除
-            for addr, info in list(self.clients.items()):
-                if now - info['last_active'] > CLIENT_TIMEOUT:
-                    print(f"Removing inactive client: {
-                          addr}, username={info['username']}")
+            while True:
+                # ヒープの peek/pop も受信ワーカーの heappush と競合する
+                # ため、レジストリと同じロックの下で行う
+                with self._registry_lock:
+                    if not self._expiry or self._expiry[0][0] > now:
+                        break
+                    _deadline, addr = heapq.heappop(self._expiry)
+                    info = self.clients.get(addr)
+                    if info is None:
+                        # すでに削除済み
+                        continue
+                    if now - info['last_active'] <= CLIENT_TIMEOUT:
+                        # 発言し直していて新しい期限が別に積まれている
+                        continue
+                    # 宛先配列からは末尾要素との swap-remove で O(1) 削除
+                    i = info['arr_idx']
+                    last_addr = self.client_addrs.pop()
+                    if i < len(self.client_addrs):
+                        self.client_addrs[i] = last_addr
+                        self.clients[last_addr]['arr_idx'] = i
                     del self.clients[addr]
-            time.sleep(5)  # 5 秒おきにチェック
+                print(f"Removing inactive client: {
+                      addr}, username={info['username']}")
+
+            # 次の期限まで眠る (ヒープが空なら既定の間隔)
+            with self._registry_lock:
+                next_deadline = self._expiry[0][0] if self._expiry else None
+            if next_deadline is not None:
+                sleep_for = max(0.1, next_deadline - time.time())
+            else:
+                sleep_for = CLIENT_TIMEOUT
+            time.sleep(min(sleep_for, CLIENT_TIMEOUT))
 
 
 if __name__ == "__main__":
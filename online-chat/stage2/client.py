@@ -16,12 +16,22 @@ TCRP_HEADER_SIZE = 32
 UDP_BUFFER_SIZE = 4096
 
 
+# フォーマット文字列の再パースを呼び出しごとに払わないよう、
+# struct.Struct に一度だけ束縛しておく
+_TCRP_HDR = struct.Struct('BBBB')  # TCRP ヘッダの意味のある先頭 4 バイト
+
+# ヘッダ構築用に使い回すバッファ。先頭 4 バイトだけを書き換え、
+# 残り 28 バイトはゼロ初期化のまま一度も触らない
+_tcrp_header_buf = bytearray(TCRP_HEADER_SIZE)
+
+
 def build_tcrp_header(roomNameSize, operation, state, opPayloadSize):
     """
     TCRP ヘッダを 32 バイトで構築
     """
-    opPayloadSizeRaw = bytes([opPayloadSize]) + b'\x00' * 28
-    return struct.pack('BBB29s', roomNameSize, operation, state, opPayloadSizeRaw)
+    _TCRP_HDR.pack_into(_tcrp_header_buf, 0,
+                        roomNameSize, operation, state, opPayloadSize)
+    return _tcrp_header_buf
 
 
 def parse_tcrp_header(data):
@@ -31,10 +41,8 @@ def parse_tcrp_header(data):
     """
     if len(data) < TCRP_HEADER_SIZE:
         raise ValueError("Invalid TCRP header length")
-    roomNameSize, operation, state, opPayloadSizeRaw = struct.unpack(
-        'BBB29s', data[:TCRP_HEADER_SIZE])
-    opPayloadSize = opPayloadSizeRaw[0]
-    return roomNameSize, operation, state, opPayloadSize
+    # 意味のある先頭 4 バイトだけを読む (29 バイトの中間 bytes を作らない)
+    return _TCRP_HDR.unpack_from(data, 0)
 
 
 class UDPChatClient:
@@ -51,6 +59,11 @@ class UDPChatClient:
         # OSに任せてポートを割り当て ('0.0.0.0', 0)
         self.sock.bind(('0.0.0.0', 0))
 
+        # 送信パケットの組み立てに使い回すバッファ
+        # (送信ごとの bytes 連結による中間オブジェクト生成を避ける)
+        self.send_buffer = bytearray(UDP_BUFFER_SIZE)
+        self.send_view = memoryview(self.send_buffer)
+
     def start(self):
         """
         受信スレッドを立ち上げて、メインループは送信を担当
@@ -80,16 +93,20 @@ class UDPChatClient:
         """
         サーバからのブロードキャスト(UDP)を受信して表示
         """
+        # 受信用に使い回すバッファ (このスレッド専用)。
+        # recvfrom のように受信ごとに bytes を割り当てない
+        recv_buffer = bytearray(UDP_BUFFER_SIZE)
+        recv_view = memoryview(recv_buffer)
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(UDP_BUFFER_SIZE)
+                nbytes, _, _, addr = self.sock.recvmsg_into([recv_view], 0)
             except OSError:
                 break
-            if not data:
+            if nbytes == 0:
                 continue
 
             try:
-                text = data.decode('utf-8')
+                text = recv_view[:nbytes].tobytes().decode('utf-8')
             except:
                 text = "[decode error]"
             print(text)
@@ -103,13 +120,30 @@ class UDPChatClient:
         token_bytes = self.token.encode('utf-8')
         msg_bytes = message.encode('utf-8')
 
-        packet = (bytes([len(room_bytes)]) +
-                  bytes([len(token_bytes)]) +
-                  room_bytes +
-                  token_bytes +
-                  msg_bytes)
+        if 2 + len(room_bytes) + len(token_bytes) + len(msg_bytes) \
+                > UDP_BUFFER_SIZE:
+            # バッファに収まらない場合のフォールバック。send_view が
+            # 生きている間 send_buffer はリサイズできない (BufferError)
+            # ので、素直に連結した bytes を送る
+            packet = (bytes([len(room_bytes), len(token_bytes)])
+                      + room_bytes + token_bytes + msg_bytes)
+            self.sock.sendto(packet, (TCP_HOST, UDP_PORT))
+            return
+
+        # 使い回しバッファに直接書き込んでパケットを組み立てる
+        buf = self.send_buffer
+        buf[0] = len(room_bytes)
+        buf[1] = len(token_bytes)
+        offset = 2
+        buf[offset: offset + len(room_bytes)] = room_bytes
+        offset += len(room_bytes)
+        buf[offset: offset + len(token_bytes)] = token_bytes
+        offset += len(token_bytes)
+        buf[offset: offset + len(msg_bytes)] = msg_bytes
+        offset += len(msg_bytes)
 
-        self.sock.sendto(packet, (TCP_HOST, UDP_PORT))
+        # memoryview のスライスはコピーを作らない
+        self.sock.sendto(self.send_view[:offset], (TCP_HOST, UDP_PORT))
 
 
 def tcrp_handshake_create_room(room_name, username, password=""):
@@ -145,6 +179,8 @@ def tcrp_handshake(room_name, operation, username, password):
 
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            # 32 バイトヘッダの小さな往復なので Nagle を無効化する
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             s.connect((TCP_HOST, TCP_PORT))
             s.sendall(packet)
 
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import ctypes
+import ctypes.util
+import binascii
+import heapq
+import os
+import selectors
 import socket
-import threading
 import struct
 import time
-import uuid
 
 ##
 # 設定
@@ -33,6 +37,7 @@ TCRP_HEADER_SIZE = 32
 """
 
 UDP_BUFFER_SIZE = 4096
+UDP_RECV_BATCH_SIZE = 32  # 1 回の起床でまとめて処理するデータグラム数の上限
 
 # ルーム管理用データ構造
 #   rooms[room_name] = {
@@ -59,13 +64,173 @@ rooms = {}
 #   }
 token_map = {}
 
-# スレッド間でのデータ競合を防ぐためのロック
-lock = threading.Lock()
+# サーバ全体を単一スレッドのイベントループで回すため、
+# rooms / token_map へのアクセスにロックは不要
+
+def _make_packet_builder(prefix):
+    """
+    送信者ごとに特化したブロードキャストパケットビルダを作る。
+
+    "username: " の prefix は参加時に専用バッファへ一度だけ書き込み、
+    以降の各ブロードキャストは本文のコピー 1 回だけで済む
+    (f-string 整形・encode・prefix の再コピーをすべて参加時に払う)。
+    """
+    buf = bytearray(UDP_BUFFER_SIZE)
+    view = memoryview(buf)
+    plen = len(prefix)
+    buf[:plen] = prefix  # ここで書いたきり二度と触らない
+
+    def build(message_bytes):
+        end = plen + len(message_bytes)
+        if end > UDP_BUFFER_SIZE:
+            # バッファに収まらない場合のフォールバック。view が生きている
+            # 間 buf はリサイズできない (BufferError) ので、素直に連結した
+            # bytes を返す (稀なケースなのでコピー 2 回を許容する)
+            return prefix + message_bytes
+        buf[plen:end] = message_bytes
+        # memoryview のスライスはコピーを作らない
+        return view[:end]
+
+    return build
+
+# 受信用に使い回すバッファ (データグラムごとの bytes 生成を避ける)
+udp_recv_buffer = bytearray(UDP_BUFFER_SIZE)
+
+# 参加者のアイドルタイムアウト (秒)
+PARTICIPANT_TIMEOUT = 60
+
+# (期限, token) の最小ヒープ。発言のたびに新しい期限を積み、
+# 古いエントリは取り出すときに検証して捨てる (lazy deletion)。
+# 全参加者を定期的に走査する必要がなくなる。
+participant_expiry = []
+
+# パケット処理のホットパスを C に落とした Cython 版 (udp_core.pyx)。
+# `cythonize -3 -i udp_core.pyx` でビルドした場合のみ有効になり、
+# 無ければこのファイル内の純 Python 実装を使う。
+try:
+    from udp_core import process_packet as _process_packet_c
+except ImportError:
+    _process_packet_c = None
+
+# ============================================================
+# sendmmsg(2) ラッパ
+# Python の socket モジュールには無いので libc を ctypes で直接呼ぶ。
+# 同じパケットを N 宛先へ送るとき、sendto を N 回呼ぶ代わりに
+# 1 回のシステムコールでまとめて送信できる。
+# ============================================================
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _HAS_SENDMMSG = hasattr(_libc, 'sendmmsg')
+except (OSError, TypeError):
+    _libc = None
+    _HAS_SENDMMSG = False
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def pack_sockaddr_in(addr):
+    """(ip, port) タプルを struct sockaddr_in のバイト列 (16 バイト) にする"""
+    ip, port = addr
+    return (struct.pack('=H', int(socket.AF_INET)) +
+            struct.pack('!H', port) +
+            socket.inet_aton(ip) +
+            bytes(8))
+
+
+def sendmmsg_to_all(sock, packet, addrs, sockaddrs=None):
+    """
+    同じ packet を addrs の全宛先へ送信する。
+    sendmmsg(2) が使える環境では 1 回のシステムコールにまとめ、
+    使えない環境では sendto のループにフォールバックする。
+    sockaddrs にパック済み sockaddr_in を渡すと宛先の再パックを省ける。
+    """
+    if not addrs:
+        return
+
+    if not _HAS_SENDMMSG:
+        for addr in addrs:
+            try:
+                sock.sendto(packet, addr)
+            except OSError:
+                pass
+        return
+
+    # ペイロードは全員共通なので iovec は 1 つを共有する
+    payload = ctypes.create_string_buffer(bytes(packet), len(packet))
+    iov = _IoVec(ctypes.cast(payload, ctypes.c_void_p), len(packet))
+
+    if sockaddrs is None:
+        sockaddrs = [pack_sockaddr_in(addr) for addr in addrs]
+
+    n = len(addrs)
+    msgs = (_MMsgHdr * n)()
+    # sockaddr バッファが GC されないよう送信完了まで保持する
+    sa_buffers = []
+    for i in range(n):
+        sa = ctypes.create_string_buffer(sockaddrs[i], 16)
+        sa_buffers.append(sa)
+        msgs[i].msg_hdr.msg_name = ctypes.cast(sa, ctypes.c_void_p)
+        msgs[i].msg_hdr.msg_namelen = 16
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iov)
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < n:
+        r = _libc.sendmmsg(
+            sock.fileno(),
+            ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)),
+            n - sent, 0)
+        if r <= 0:
+            # 送信エラー時は残りを諦める (UDP なので再送しない)
+            break
+        sent += r
+
+
+# トークン用の乱数プール。os.urandom を 1 回呼ぶたびに 4 KiB
+# (= 256 トークン分) 確保し、16 バイトずつ切り出して使う。
+# uuid.uuid4() のように発行ごとに urandom の syscall と
+# UUID オブジェクト生成を払わずに済む。
+_token_pool = b''
+_token_pool_pos = 0
 
 
 def generate_token():
-    """最大255バイト程度なら UUID 文字列で十分。"""
-    return str(uuid.uuid4())
+    """最大255バイト程度なら 16 バイト乱数の hex 文字列で十分。"""
+    global _token_pool, _token_pool_pos
+    if _token_pool_pos >= len(_token_pool):
+        _token_pool = os.urandom(4096)
+        _token_pool_pos = 0
+    raw = _token_pool[_token_pool_pos: _token_pool_pos + 16]
+    _token_pool_pos += 16
+    return binascii.hexlify(raw).decode('ascii')
+
+
+# フォーマット文字列の再パースを呼び出しごとに払わないよう、
+# struct.Struct に一度だけ束縛しておく
+_TCRP_HDR = struct.Struct('BBBB')   # TCRP ヘッダの意味のある先頭 4 バイト
+_UDP_SIZES = struct.Struct('BB')    # UDP パケット先頭の 2 つの長さバイト
+
+# ヘッダ構築用に使い回すバッファ。先頭 4 バイトだけを書き換え、
+# 残り 28 バイトはゼロ初期化のまま一度も触らない
+_tcrp_header_buf = bytearray(TCRP_HEADER_SIZE)
 
 
 def parse_tcrp_header(header_bytes: bytes):
@@ -75,12 +240,8 @@ def parse_tcrp_header(header_bytes: bytes):
     """
     if len(header_bytes) < TCRP_HEADER_SIZE:
         raise ValueError("Invalid TCRP header length")
-    # 'BBB29s' = 1byte + 1byte + 1byte + 29byte = 32byte
-    roomNameSize, operation, state, opPayloadSizeRaw = struct.unpack(
-        'BBB29s', header_bytes)
-    # opPayloadSizeRaw[0] をペイロードサイズとして扱う
-    opPayloadSize = opPayloadSizeRaw[0]
-    return roomNameSize, operation, state, opPayloadSize
+    # 意味のある先頭 4 バイトだけを読む (29 バイトの中間 bytes を作らない)
+    return _TCRP_HDR.unpack_from(header_bytes, 0)
 
 
 def build_tcrp_header(roomNameSize, operation, state, opPayloadSize):
@@ -88,29 +249,69 @@ def build_tcrp_header(roomNameSize, operation, state, opPayloadSize):
     TCRP ヘッダを 32 バイトで構築
     """
     # opPayloadSize は先頭1バイト、残り28バイトはゼロ詰め
-    opPayloadSizeRaw = bytes([opPayloadSize]) + b'\x00' * 28
-    return struct.pack('BBB29s', roomNameSize, operation, state, opPayloadSizeRaw)
+    _TCRP_HDR.pack_into(_tcrp_header_buf, 0,
+                        roomNameSize, operation, state, opPayloadSize)
+    return _tcrp_header_buf
 
 
-def handle_tcp_client(conn, addr):
+class TCRPConnection:
     """
-    受け付けた TCP クライアントと TCRP でやり取りし、ルーム作成/参加を処理
+    非ブロッキング TCP クライアント 1 本分の受信状態。
+    ヘッダ 32 バイト → ボディの順に読み進める小さな状態機械。
     """
-    try:
-        header_data = conn.recv(TCRP_HEADER_SIZE)
-        if not header_data:
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.buffer = b''
+        self.body_size = None  # ヘッダ受信完了後に確定する
+
+    def on_readable(self, sel):
+        """
+        読み出し可能になったら呼ばれる。リクエストが揃った時点で処理し、
+        応答を返してクローズする (TCRP は 1 接続 1 リクエスト)。
+        """
+        try:
+            chunk = self.conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close(sel)
             return
 
-        roomNameSize, operation, state, opPayloadSize = parse_tcrp_header(
-            header_data)
+        if not chunk:
+            # クライアントが切断した
+            self.close(sel)
+            return
+
+        self.buffer += chunk
 
-        body_size = roomNameSize + opPayloadSize
-        body_data = b''
-        while len(body_data) < body_size:
-            chunk = conn.recv(body_size - len(body_data))
-            if not chunk:
+        # ヘッダがまだならヘッダから読む
+        if self.body_size is None:
+            if len(self.buffer) < TCRP_HEADER_SIZE:
                 return
-            body_data += chunk
+            roomNameSize, operation, state, opPayloadSize = parse_tcrp_header(
+                self.buffer[:TCRP_HEADER_SIZE])
+            self.header = (roomNameSize, operation, state, opPayloadSize)
+            self.body_size = roomNameSize + opPayloadSize
+
+        if len(self.buffer) < TCRP_HEADER_SIZE + self.body_size:
+            return
+
+        try:
+            self.handle_request()
+        except Exception as e:
+            print(f"[TCP] Error handling client {self.addr}: {e}")
+        finally:
+            self.close(sel)
+
+    def handle_request(self):
+        """
+        揃ったヘッダ + ボディからルーム作成/参加を処理
+        """
+        roomNameSize, operation, state, opPayloadSize = self.header
+        body_data = self.buffer[TCRP_HEADER_SIZE:
+                                TCRP_HEADER_SIZE + self.body_size]
 
         # ボディを分割
         room_name_bytes = body_data[:roomNameSize]
@@ -120,63 +321,79 @@ def handle_tcp_client(conn, addr):
         except:
             room_name = "?"
 
-        # payload には "username password" のように空白区切りで入れる例
-        try:
-            payload_decoded = payload_bytes.decode('utf-8')
-        except:
-            payload_decoded = ""
-        parts = payload_decoded.split()
-        username = parts[0] if len(parts) >= 1 else "unknown"
-        password = parts[1] if len(parts) >= 2 else ""
+        # payload には "username password" のように空白区切りで入れる例。
+        # 全体を decode して split でリストを作る代わりに、最初の空白
+        # バイトを探して 2 つのスライスだけを decode する
+        sp = payload_bytes.find(b' ')
+        if sp < 0:
+            username = payload_bytes.decode('utf-8', 'replace') or "unknown"
+            password = ""
+        else:
+            username = payload_bytes[:sp].decode('utf-8', 'replace')
+            password = payload_bytes[sp + 1:].decode('utf-8', 'replace')
 
         if operation == 1:  # Create room
-            handle_create_room(conn, room_name, username, password)
+            handle_create_room(self.conn, room_name, username, password)
         elif operation == 2:  # Join room
-            handle_join_room(conn, room_name, username, password)
+            handle_join_room(self.conn, room_name, username, password)
         else:
             # 無効オペレーション
-            send_tcrp_response(conn, room_name, operation,
+            send_tcrp_response(self.conn, room_name, operation,
                                1, 0, b"INVALID_OPERATION")
 
-    except Exception as e:
-        print(f"[TCP] Error handling client {addr}: {e}")
-    finally:
-        conn.close()
+    def close(self, sel):
+        try:
+            sel.unregister(self.conn)
+        except (KeyError, ValueError):
+            pass
+        self.conn.close()
 
 
 def handle_create_room(conn, room_name, username, password):
     """
     新規ルーム作成
     """
-    with lock:
-        # 既存ルームがアクティブならエラーとする簡易方針
-        if room_name in rooms and rooms[room_name]['active']:
-            send_tcrp_response(conn, room_name, 1, 1, 0,
-                               b"ROOM_ALREADY_EXISTS")
-            return
+    # 既存ルームがアクティブならエラーとする簡易方針
+    if room_name in rooms and rooms[room_name]['active']:
+        send_tcrp_response(conn, room_name, 1, 1, 0,
+                           b"ROOM_ALREADY_EXISTS")
+        return
 
-        # 新しいトークン作成
-        token = generate_token()
-
-        rooms[room_name] = {
-            'host_token': token,
-            'participants': {
-                token: {
-                    'username': username,
-                    'ip': None,
-                    'last_active': time.time()
-                }
-            },
-            'password': password,
-            'active': True
-        }
-
-        token_map[token] = {
-            'room': room_name,
-            'username': username,
-            'ip': None,
-            'port': None
-        }
+    # 新しいトークン作成
+    # (UDP パケット内のトークンをそのまま辞書キーにできるよう bytes で管理)
+    token = generate_token()
+    token_b = token.encode('utf-8')
+
+    rooms[room_name] = {
+        'host_token': token_b,
+        'participants': {
+            token_b: {
+                'username': username,
+                # ブロードキャストのパケット組み立てを参加時に特化しておく
+                'build': _make_packet_builder((username + ': ').encode('utf-8')),
+                'ip': None,
+                'last_active': time.time(),
+                'arr_idx': 0
+            }
+        },
+        # ブロードキャスト用のトークン配列。参加で append、離脱は
+        # 末尾との swap-remove で O(1)。ブロードキャスト側は辞書の
+        # キー走査ではなくこの配列をそのまま読む。
+        'participants_arr': [token_b],
+        'password': password,
+        'active': True
+    }
+
+    token_map[token_b] = {
+        'room': room_name,
+        'room_bytes': room_name.encode('utf-8'),  # decode なしの照合用
+        'username': username,
+        'ip': None,
+        'port': None,
+        'sockaddr': None  # 初回 UDP 受信時にパック済み sockaddr_in を入れる
+    }
+    heapq.heappush(participant_expiry, (time.time() + PARTICIPANT_TIMEOUT,
+                                        token_b))
 
     # 成功応答 (state=2) としてトークンを返す
     send_tcrp_response(conn, room_name, 1, 2,
@@ -188,188 +405,272 @@ def handle_join_room(conn, room_name, username, password):
     """
     既存ルーム参加
     """
-    with lock:
-        if room_name not in rooms or not rooms[room_name]['active']:
-            send_tcrp_response(conn, room_name, 2, 1, 0, b"ROOM_NOT_FOUND")
-            return
-        # パスワードチェック
-        if rooms[room_name]['password'] != password:
-            send_tcrp_response(conn, room_name, 2, 1, 0, b"WRONG_PASSWORD")
-            return
+    if room_name not in rooms or not rooms[room_name]['active']:
+        send_tcrp_response(conn, room_name, 2, 1, 0, b"ROOM_NOT_FOUND")
+        return
+    # パスワードチェック
+    if rooms[room_name]['password'] != password:
+        send_tcrp_response(conn, room_name, 2, 1, 0, b"WRONG_PASSWORD")
+        return
 
-        # トークン発行
-        token = generate_token()
-        rooms[room_name]['participants'][token] = {
-            'username': username,
-            'ip': None,
-            'last_active': time.time()
-        }
-        token_map[token] = {
-            'room': room_name,
-            'username': username,
-            'ip': None,
-            'port': None
-        }
+    # トークン発行
+    # (UDP パケット内のトークンをそのまま辞書キーにできるよう bytes で管理)
+    token = generate_token()
+    token_b = token.encode('utf-8')
+    rooms[room_name]['participants'][token_b] = {
+        'username': username,
+        # ブロードキャストのパケット組み立てを参加時に特化しておく
+        'build': _make_packet_builder((username + ': ').encode('utf-8')),
+        'ip': None,
+        'last_active': time.time(),
+        'arr_idx': len(rooms[room_name]['participants_arr'])
+    }
+    rooms[room_name]['participants_arr'].append(token_b)
+    token_map[token_b] = {
+        'room': room_name,
+        'room_bytes': room_name.encode('utf-8'),  # decode なしの照合用
+        'username': username,
+        'ip': None,
+        'port': None,
+        'sockaddr': None  # 初回 UDP 受信時にパック済み sockaddr_in を入れる
+    }
+    heapq.heappush(participant_expiry, (time.time() + PARTICIPANT_TIMEOUT,
+                                        token_b))
 
     send_tcrp_response(conn, room_name, 2, 2,
                        len(token), token.encode('utf-8'))
     print(f"[TCP] Room '{room_name}' joined by '{username}' (token={token})")
 
 
+# 応答パケット組み立て用に使い回すバッファ
+# (ヘッダ 32 バイト + ルーム名 + ペイロードを連結なしで詰める)
+_tcrp_resp_buf = bytearray(TCRP_HEADER_SIZE + 256 + 512)
+_tcrp_resp_view = memoryview(_tcrp_resp_buf)
+
+
 def send_tcrp_response(conn, room_name, operation, state, payload_size, payload_bytes):
     """
-    TCRP 用の応答パケットを送信
+    TCRP 用の応答パケットを送信。
+    ヘッダとボディを使い回しバッファへ直接組み立て、
+    `header + body` の連結による中間オブジェクトを作らない。
     """
     room_name_bytes = room_name.encode('utf-8')
     roomNameSize = len(room_name_bytes)
-    header = build_tcrp_header(roomNameSize, operation, state, payload_size)
-    body = room_name_bytes + payload_bytes
-    conn.sendall(header + body)
 
+    # ヘッダ (オフセット 4〜31 はゼロ初期化のまま触らない)
+    _TCRP_HDR.pack_into(_tcrp_resp_buf, 0,
+                        roomNameSize, operation, state, payload_size)
 
-def tcp_server_loop():
+    # ボディ
+    offset = TCRP_HEADER_SIZE
+    _tcrp_resp_buf[offset: offset + roomNameSize] = room_name_bytes
+    offset += roomNameSize
+    _tcrp_resp_buf[offset: offset + len(payload_bytes)] = payload_bytes
+    offset += len(payload_bytes)
+
+    # memoryview のスライスはコピーを作らない
+    conn.sendall(_tcrp_resp_view[:offset])
+
+
+def on_tcp_accept(sel, s):
+    """
+    TCP リスナが readable になったら呼ばれる: TCRP 接続を受け付ける
+    """
+    try:
+        conn, addr = s.accept()
+    except OSError:
+        return
+    print(f"[TCP] Connection from {addr}")
+    conn.setblocking(False)
+    # TCRP は 32 バイトヘッダの小さな往復なので Nagle を無効化する
+    # (クライアント ACK 待ちで最大 40ms 遅延するのを防ぐ)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    client = TCRPConnection(conn, addr)
+    sel.register(conn, selectors.EVENT_READ,
+                 lambda sel, _sock: client.on_readable(sel))
+
+
+def on_udp_readable(sel, s):
     """
-    TCP サーバループ: TCRP ハンドシェイク受け付け
+    UDP ソケットが readable になったら呼ばれる:
+    カーネルのキューに溜まっている分を MSG_DONTWAIT でまとめて読み出す
+    (recvmmsg 相当のバッチ処理)
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((TCP_HOST, TCP_PORT))
-        s.listen(5)
-        print(f"[TCP] Listening on {TCP_HOST}:{TCP_PORT} ...")
+    for _ in range(UDP_RECV_BATCH_SIZE):
+        try:
+            nbytes, _, _, addr = s.recvmsg_into(
+                [udp_recv_buffer], 0, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # キューが空になった
+            break
+        except OSError:
+            return
+        handle_udp_packet(s, bytes(udp_recv_buffer[:nbytes]), addr)
 
-        while True:
-            conn, addr = s.accept()
-            print(f"[TCP] Connection from {addr}")
-            threading.Thread(target=handle_tcp_client, args=(
-                conn, addr), daemon=True).start()
 
+def process_packet(data, addr, token_map, rooms):
+    """
+    1 データグラムをパース・検証し、last_active を更新する。
+    有効なパケットなら (room_name, token, participant, message_bytes) を、
+    無効なら None を返す。(udp_core.pyx の純 Python 版)
+    """
+    if len(data) < 2:
+        return None
+
+    # パケット解析。memoryview のスライスはコピーを作らないので、
+    # bytes 化するのは辞書キーに必要なトークンだけ。
+    roomNameSize, tokenSize = _UDP_SIZES.unpack_from(data, 0)
+    offset = 2
+
+    if len(data) < offset + roomNameSize + tokenSize:
+        return None
+
+    mv = memoryview(data)
+    token = bytes(mv[offset + roomNameSize: offset + roomNameSize + tokenSize])
+    message_bytes = mv[offset + roomNameSize + tokenSize:]
+
+    # token が有効か
+    entry = token_map.get(token)
+    if entry is None:
+        return None
+    # ルーム名は decode せずバイト列のまま照合する
+    if entry['room_bytes'] != mv[offset: offset + roomNameSize]:
+        return None
+    room_name = entry['room']
+
+    room_info = rooms.get(room_name)
+    if room_info is None or not room_info['active']:
+        return None
+
+    # IP, Port 未設定なら登録
+    if entry['ip'] is None:
+        entry['ip'] = addr[0]
+    if entry['port'] is None:
+        entry['port'] = addr[1]
+
+    # IP が一致するか (仕様: トークンと IP の組み合わせが合わないと無視)
+    if entry['ip'] != addr[0]:
+        return None
+    # (必要に応じてポートの変化も許容 or 不許容にする)
 
-def udp_server_loop():
+    # 宛先 sockaddr_in は初回にパックして使い回す
+    if entry['sockaddr'] is None:
+        entry['sockaddr'] = pack_sockaddr_in((entry['ip'], entry['port']))
+
+    # last_active 更新
+    participant = room_info['participants'][token]
+    participant['last_active'] = time.time()
+
+    return (room_name, token, participant, message_bytes)
+
+
+def handle_udp_packet(s, data, addr):
     """
-    UDP サーバループ: チャットメッセージ受け取り & ブロードキャスト
+    受信した 1 データグラムを検証し、同じルームへブロードキャストする
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.bind((TCP_HOST, UDP_PORT))
-        print(f"[UDP] Listening on {TCP_HOST}:{UDP_PORT} ...")
+    if not data:
+        return
 
-        while True:
-            try:
-                data, addr = s.recvfrom(UDP_BUFFER_SIZE)
-            except OSError:
-                break
+    # Cython 版がビルドされていればそちらを使う
+    if _process_packet_c is not None:
+        result = _process_packet_c(data, addr, token_map, rooms)
+    else:
+        result = process_packet(data, addr, token_map, rooms)
 
-            if not data:
-                continue
+    if result is None:
+        return
+    room_name, token, participant, message_bytes = result
 
-            # パケット解析
-            roomNameSize = data[0]
-            tokenSize = data[1]
-            offset = 2
+    # 新しい期限を積む (古いエントリはクリーンアップ時に捨てられる)
+    heapq.heappush(participant_expiry,
+                   (participant['last_active'] + PARTICIPANT_TIMEOUT, token))
 
-            room_name_bytes = data[offset: offset + roomNameSize]
-            offset += roomNameSize
+    # 本文の decode はログ表示のためだけに行う
+    message = bytes(message_bytes).decode('utf-8', errors='replace')
+    print(f"[UDP] Room={room_name}, User={
+          participant['username']}, addr={addr}: {message}")
 
-            token_bytes = data[offset: offset + tokenSize]
-            offset += tokenSize
+    # ブロードキャスト (本文は再エンコードせずバイト列のまま使う)
+    broadcast_udp_message(s, room_name, participant['build'], message_bytes)
 
-            message_bytes = data[offset:]
 
-            try:
-                room_name = room_name_bytes.decode('utf-8')
-                token = token_bytes.decode('utf-8')
-                message = message_bytes.decode('utf-8')
-            except:
-                continue
-
-            with lock:
-                # token が有効か
-                if token not in token_map:
-                    continue
-                mapped_room = token_map[token]['room']
-                if mapped_room != room_name:
-                    continue
-                if not rooms.get(room_name, {}).get('active', False):
-                    continue
-
-                # IP, Port 未設定なら登録
-                if token_map[token]['ip'] is None:
-                    token_map[token]['ip'] = addr[0]
-                if token_map[token]['port'] is None:
-                    token_map[token]['port'] = addr[1]
-
-                # IP が一致するか (仕様: トークンと IP の組み合わせが合わないと無視)
-                if token_map[token]['ip'] != addr[0]:
-                    continue
-                # (必要に応じてポートの変化も許容 or 不許容にする)
-
-                # last_active 更新
-                rooms[room_name]['participants'][token]['last_active'] = time.time()
-                username = rooms[room_name]['participants'][token]['username']
-
-            print(f"[UDP] Room={room_name}, User={
-                  username}, addr={addr}: {message}")
-
-            # ブロードキャスト
-            broadcast_udp_message(s, room_name, username, message)
-
-
-def broadcast_udp_message(sock, room_name, username, message):
+def broadcast_udp_message(sock, room_name, build_packet, message_bytes):
     """
-    同じルームの全参加者に (username: message) を送信
+    同じルームの全参加者に (username: message) を送信。
+    build_packet は参加時に _make_packet_builder で作った送信者専用の
+    ビルダ、message_bytes は受信パケット内の本文バイト列。
     """
-    with lock:
-        if room_name not in rooms or not rooms[room_name]['active']:
-            return
+    if room_name not in rooms or not rooms[room_name]['active']:
+        return
 
-        send_data = f"{username}: {message}".encode('utf-8')
+    # prefix 済みバッファへ本文 1 回のコピーだけで組み立てる
+    packet = build_packet(message_bytes)
 
-        for tkn in rooms[room_name]['participants'].keys():
-            # 送信先の IP, Port を token_map から取得
-            ip = token_map[tkn].get('ip')
-            port = token_map[tkn].get('port')
-            if ip and port:
-                recipient_addr = (ip, port)
-                try:
-                    sock.sendto(send_data, recipient_addr)
-                except:
-                    pass
+    # 送信先の IP, Port とパック済み sockaddr を token_map から集める
+    # (辞書のキー走査ではなくトークン配列をそのまま読む)
+    recipients = []
+    sockaddrs = []
+    for tkn in rooms[room_name]['participants_arr']:
+        entry = token_map[tkn]
+        if entry['sockaddr'] is not None:
+            recipients.append((entry['ip'], entry['port']))
+            sockaddrs.append(entry['sockaddr'])
+
+    # 全参加者宛てを 1 回のシステムコールでまとめて送信
+    sendmmsg_to_all(sock, packet, recipients, sockaddrs)
 
 
-def cleanup_rooms_loop():
+def cleanup_rooms():
     """
-    定期的にルームや参加者のタイムアウト処理を実行
+    期限ヒープの先頭だけを見てタイムアウトした参加者を削除する。
+    全ルーム・全参加者の走査は行わず、実際に期限が来たエントリの分しか
+    仕事をしない。(イベントループから期限が来るたびに呼ばれる)
     """
-    while True:
-        time.sleep(5)
-        now = time.time()
-
-        with lock:
-            for room_name, room_info in list(rooms.items()):
-                if not room_info['active']:
-                    continue
-
-                # ホストがいなければルームを終了
-                host_token = room_info['host_token']
-                if host_token not in room_info['participants']:
-                    close_room(room_name)
-                    continue
-
-                # 参加者の last_active が一定時間超過なら削除
-                remove_list = []
-                for tkn, pinfo in room_info['participants'].items():
-                    if (now - pinfo['last_active']) > 60:  # 60秒以上アイドル
-                        remove_list.append(tkn)
-
-                for tkn in remove_list:
-                    print(f"[CLEANUP] Removing inactive participant {
-                          tkn} in {room_name}")
-                    del room_info['participants'][tkn]
-                    if tkn in token_map:
-                        del token_map[tkn]
-
-                # ホストが消えたか再チェック
-                if host_token not in room_info['participants']:
-                    close_room(room_name)
+    now = time.time()
+
+    while participant_expiry and participant_expiry[0][0] <= now:
+        _deadline, tkn = heapq.heappop(participant_expiry)
+
+        entry = token_map.get(tkn)
+        if entry is None:
+            # すでに削除済み
+            continue
+
+        room_name = entry['room']
+        room_info = rooms.get(room_name)
+        if room_info is None or not room_info['active']:
+            continue
+
+        pinfo = room_info['participants'].get(tkn)
+        if pinfo is None:
+            continue
+        if (now - pinfo['last_active']) <= PARTICIPANT_TIMEOUT:
+            # 発言し直していて新しい期限が別に積まれている
+            continue
+
+        print(f"[CLEANUP] Removing inactive participant {
+              tkn.decode('utf-8', 'replace')} in {room_name}")
+        # トークン配列からは末尾要素との swap-remove で O(1) 削除
+        arr = room_info['participants_arr']
+        i = pinfo['arr_idx']
+        last_tkn = arr.pop()
+        if i < len(arr):
+            arr[i] = last_tkn
+            room_info['participants'][last_tkn]['arr_idx'] = i
+        del room_info['participants'][tkn]
+        del token_map[tkn]
+
+        # ホストが消えたらルームごとクローズ
+        if room_info['host_token'] == tkn:
+            close_room(room_name)
+
+
+def next_expiry_deadline():
+    """次にクリーンアップが必要になる時刻 (ヒープが空なら None)"""
+    if participant_expiry:
+        return participant_expiry[0][0]
+    return None
 
 
 def close_room(room_name):
@@ -384,22 +685,60 @@ def close_room(room_name):
         if tkn in token_map:
             del token_map[tkn]
     rooms[room_name]['participants'].clear()
+    rooms[room_name]['participants_arr'].clear()
     rooms[room_name]['active'] = False
 
 
 def main():
     print("=== TCRP + UDP Chat Server (Stage 2) - with port tracking ===")
-    # スレッド起動
-    threading.Thread(target=tcp_server_loop, daemon=True).start()
-    threading.Thread(target=udp_server_loop, daemon=True).start()
-    threading.Thread(target=cleanup_rooms_loop, daemon=True).start()
 
-    # メインスレッドは単純に待機
+    # TCP 受付・UDP 受信・クリーンアップを単一スレッドの
+    # selectors (Linux では epoll) イベントループにまとめる。
+    # スレッド間のロック競合とコンテキストスイッチが一切なくなる。
+    sel = selectors.DefaultSelector()
+
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_sock.bind((TCP_HOST, TCP_PORT))
+    tcp_sock.listen(5)
+    tcp_sock.setblocking(False)
+    sel.register(tcp_sock, selectors.EVENT_READ, on_tcp_accept)
+    print(f"[TCP] Listening on {TCP_HOST}:{TCP_PORT} ...")
+
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # バースト時のドロップを避けるため受信/送信バッファを広げる
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+    udp_sock.bind((TCP_HOST, UDP_PORT))
+    udp_sock.setblocking(False)
+    sel.register(udp_sock, selectors.EVENT_READ, on_udp_readable)
+    print(f"[UDP] Listening on {TCP_HOST}:{UDP_PORT} ...")
+
     try:
         while True:
-            time.sleep(1)
+            # 最も早い参加者期限まで待つ (期限が無ければイベントのみ待つ)
+            deadline = next_expiry_deadline()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0.0, deadline - time.time())
+            events = sel.select(timeout)
+            for key, _mask in events:
+                callback = key.data
+                try:
+                    callback(sel, key.fileobj)
+                except Exception as e:
+                    # ハンドラの例外 1 つでサーバ全体が落ちないようにする
+                    # (細工されたパケット 1 発での停止を防ぐ)
+                    print(f"[ERROR] Handler error: {e!r}")
+
+            cleanup_rooms()
     except KeyboardInterrupt:
         print("\nShutting down server...")
+    finally:
+        sel.close()
+        tcp_sock.close()
+        udp_sock.close()
 
 
 if __name__ == "__main__":
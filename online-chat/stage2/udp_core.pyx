@@ -0,0 +1,82 @@
+# cython: language_level=3
+"""
+UDP チャットパケット処理のホットパス (Cython 版)。
+
+server.py の handle_udp_packet の中の「パース + 検証 + last_active 更新」を
+C レベルで実行する。ビルドは任意で、無ければ server.py が
+純 Python 実装にフォールバックする。
+
+ビルド方法:
+    pip install cython
+    cythonize -3 -i udp_core.pyx
+"""
+
+from time import time as _time
+
+from socket import AF_INET, inet_aton
+from struct import pack as _pack
+
+
+cdef bytes _pack_sockaddr_in(str ip, int port):
+    """(ip, port) を struct sockaddr_in のバイト列 (16 バイト) にする"""
+    return (_pack('=H', <int>AF_INET) +
+            _pack('!H', port) +
+            inet_aton(ip) +
+            bytes(8))
+
+
+cpdef tuple process_packet(bytes data, tuple addr, dict token_map, dict rooms):
+    """
+    1 データグラムをパース・検証し、last_active を更新する。
+    有効なパケットなら (room_name, token, participant, message_bytes) を、
+    無効なら None を返す。
+    """
+    cdef Py_ssize_t n = len(data)
+    cdef Py_ssize_t room_name_size, token_size, offset
+
+    if n < 2:
+        return None
+
+    room_name_size = data[0]
+    token_size = data[1]
+    offset = 2
+
+    if n < offset + room_name_size + token_size:
+        return None
+
+    # bytes 化するのは辞書キーに必要なトークンと本文だけ。
+    # ルーム名は decode せずバイト列のまま照合する。
+    token = data[offset + room_name_size: offset + room_name_size + token_size]
+    message_bytes = data[offset + room_name_size + token_size:]
+
+    # token が有効か
+    entry = token_map.get(token)
+    if entry is None:
+        return None
+    if entry['room_bytes'] != data[offset: offset + room_name_size]:
+        return None
+    room_name = entry['room']
+
+    room_info = rooms.get(room_name)
+    if room_info is None or not room_info['active']:
+        return None
+
+    # IP, Port 未設定なら登録
+    if entry['ip'] is None:
+        entry['ip'] = addr[0]
+    if entry['port'] is None:
+        entry['port'] = addr[1]
+
+    # IP が一致するか (仕様: トークンと IP の組み合わせが合わないと無視)
+    if entry['ip'] != addr[0]:
+        return None
+
+    # 宛先 sockaddr_in は初回にパックして使い回す
+    if entry['sockaddr'] is None:
+        entry['sockaddr'] = _pack_sockaddr_in(entry['ip'], entry['port'])
+
+    # last_active 更新
+    participant = room_info['participants'][token]
+    participant['last_active'] = _time()
+
+    return (room_name, token, participant, message_bytes)
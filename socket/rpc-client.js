@@ -46,6 +46,15 @@ const requests = [
 
 const client = new net.Socket();
 
+// フレーミング: [4 bytes: body_size (unsigned int, big-endian)][body (JSON)]
+// TCP の分割/結合があっても正確に 1 メッセージずつやり取りできる
+function sendFramed(sock, obj) {
+  const body = Buffer.from(JSON.stringify(obj));
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(body.length, 0);
+  sock.write(Buffer.concat([header, body]));
+}
+
 client.connect(PORT, HOST, () => {
   console.log(`[INFO] Connected to server ${HOST}:${PORT}`);
 
@@ -64,21 +73,28 @@ client.connect(PORT, HOST, () => {
       return;
     }
 
-    const reqJson = JSON.stringify(requests[i]);
-    console.log("[SEND]", reqJson);
-    client.write(reqJson);
+    console.log("[SEND]", JSON.stringify(requests[i]));
+    sendFramed(client, requests[i]);
     i++;
   }, 1000);
 });
 
-// サーバからのデータ受信
+// サーバからのデータ受信 (長さプレフィックスでフレームを切り出す)
+let recvBuf = Buffer.alloc(0);
 client.on("data", (data) => {
-  // サーバが返す JSON をパースして表示
-  try {
-    const response = JSON.parse(data.toString());
-    console.log("[RECV]", response);
-  } catch (e) {
-    console.error("[ERROR] JSON parse failed:", e, data.toString());
+  recvBuf = Buffer.concat([recvBuf, data]);
+  while (recvBuf.length >= 4) {
+    const bodyLen = recvBuf.readUInt32BE(0);
+    if (recvBuf.length < 4 + bodyLen) break; // フレームの残りを待つ
+    const body = recvBuf.subarray(4, 4 + bodyLen);
+    recvBuf = recvBuf.subarray(4 + bodyLen);
+    // サーバが返す JSON をパースして表示
+    try {
+      const response = JSON.parse(body.toString());
+      console.log("[RECV]", response);
+    } catch (e) {
+      console.error("[ERROR] JSON parse failed:", e, body.toString());
+    }
   }
 });
 
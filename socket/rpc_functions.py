@@ -1,10 +1,19 @@
 # rpc_functions.py
 import math
+from collections import Counter
+
+# libm の関数はモジュールスコープに束縛して math.xxx の属性引きを
+# 呼び出しごとに払わない (中身はどれも 1 回の C 呼び出しで、
+# Python レベルのループを持たないので JIT コンパイルの対象はない)
+_floor = math.floor
+_sqrt = math.sqrt
+_cbrt = math.cbrt
+_pow = math.pow
 
 
 def floor_func(x: float) -> int:
     """10進数 x を最も近い整数に切り捨てる (math.floor)"""
-    return math.floor(x)
+    return _floor(x)
 
 
 def nroot(n: int, x: int) -> float:
@@ -14,7 +23,13 @@ def nroot(n: int, x: int) -> float:
     """
     if n == 0:
         raise ValueError("n must not be zero.")
-    return x ** (1.0 / n)
+    # よく使う整数根は libm の専用関数へ直行させる
+    if n == 2:
+        return _sqrt(x)
+    if n == 3:
+        return _cbrt(x)
+    # 汎用の ** 演算子 (__pow__ ディスパッチ) を避けて math.pow を使う
+    return _pow(x, 1.0 / n)
 
 
 def reverse_str(s: str) -> str:
@@ -26,8 +41,12 @@ def valid_anagram(str1: str, str2: str) -> bool:
     """
     2つの文字列 str1, str2 がアナグラムか判定
     (文字の出現回数が同じであるかどうか)
+    ソート O(n log n) ではなく出現回数カウント O(n) で比較する
     """
-    return sorted(str1) == sorted(str2)
+    # 長さが違えばカウントするまでもなくアナグラムではない
+    if len(str1) != len(str2):
+        return False
+    return Counter(str1) == Counter(str2)
 
 
 def sort_strings(str_arr: list[str]) -> list[str]:
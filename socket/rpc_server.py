@@ -1,136 +1,213 @@
 # rpc_server.py
-import socket
-import threading
-import json
+import asyncio
 import math
+import os
+import socket
+import struct
 from rpc_functions import floor_func, nroot, reverse_str, valid_anagram, sort_strings
 
-# サーバが提供するメソッド (string -> callable)
+# フレーミング: [4 bytes: body_size (unsigned int, big-endian)][body (JSON)]
+# 「1 recv = 1 リクエスト」というこれまでの仮定は TCP の分割/結合で
+# 壊れるため、長さプレフィックスで正確に 1 メッセージずつ切り出す
+# (クライアント側のパイプライン送信も可能になる)
+_FRAME_LEN = struct.Struct('!I')
+
+# 同時に処理するクライアントセッション数の上限。
+# バースト時でも並列度 (とメモリ) が無制限に伸びないよう、
+# スレッドプールの max_workers と同じ感覚で抑える
+MAX_CONCURRENT_CLIENTS = min(32, (os.cpu_count() or 1) * 4)
+
+# JSON は orjson があればそちらを使う (bytes を直接返し、パース/
+# シリアライズとも速い)。無ければ標準ライブラリ json を
+# 同じインターフェース (bytes in / bytes out) に包んで使う
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)  # bytes を返す
+except ImportError:
+    import json
+
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# サーバが提供するメソッド (string -> (callable, 結果型名))
+# 各メソッドの戻り値の型は決まっているので、応答のたびに
+# type(result).__name__ で調べずテーブルに持っておく
 RPC_METHODS = {
-    "floor": floor_func,
-    "nroot": nroot,
-    "reverse": reverse_str,
-    "validAnagram": valid_anagram,
-    "sort": sort_strings
+    "floor": (floor_func, "int"),
+    "nroot": (nroot, "float"),
+    "reverse": (reverse_str, "str"),
+    "validAnagram": (valid_anagram, "bool"),
+    "sort": (sort_strings, "list")
 }
 
 
-def handle_client(client_socket, address):
-    """クライアントとの通信を担当する関数 (スレッドで実行想定)"""
+def _str_list(p):
+    """string[] 用の変換関数: list であることを確認して各要素を str にする"""
+    # p は配列前提
+    if not isinstance(p, list):
+        raise ValueError("Expected list of strings")
+    return [str(s) for s in p]
+
+
+# パラメータ型名 -> 変換関数 (string -> callable)
+# if/elif の文字列比較チェーンを辞書引き 1 回に置き換える
+# param_types = ["int", "float", "string", "bool", ...] などを想定
+PARAM_CONVERTERS = {
+    "int": int,
+    "float": float,
+    "double": float,
+    # 文字列 "true"/"false" で来るかどうかは要設計
+    # ここでは Python の真偽値に変換する例
+    "bool": bool,
+    "string": str,
+    "string[]": _str_list,
+}
+
+
+# start_server 実行時 (イベントループ内) に初期化するセマフォ
+_client_slots = None
+
+
+async def handle_client(reader, writer):
+    """クライアントとの通信を担当するコルーチン (イベントループ上で実行)"""
+    address = writer.get_extra_info('peername')
     print(f"[INFO] Client connected: {address}")
-    with client_socket:
-        while True:
-            data = client_socket.recv(4096)
-            if not data:
-                print(f"[INFO] Client disconnected: {address}")
-                break
-
-            # JSON をパース
-            try:
-                request = json.loads(data.decode('utf-8'))
-            except json.JSONDecodeError as e:
-                # JSON が壊れている場合はエラー応答
-                error_response = {
-                    "id": None,
-                    "error": f"JSON decode error: {str(e)}"
-                }
-                client_socket.sendall(json.dumps(
-                    error_response).encode('utf-8'))
-                continue
-
-            # リクエストから method / params / param_types / id を取得
-            method = request.get("method")
-            params = request.get("params", [])
-            param_types = request.get("param_types", [])
-            request_id = request.get("id")
-
-            # メソッドが辞書に存在するか確認
-            if method not in RPC_METHODS:
-                error_response = {
-                    "id": request_id,
-                    "error": f"Method '{method}' not found."
-                }
-                client_socket.sendall(json.dumps(
-                    error_response).encode('utf-8'))
-                continue
-
-            # パラメータの型変換を行う (簡易的)
-            # param_types = ["int", "float", "string", "bool", ...] などを想定
-            try:
-                converted_params = []
-                for p, t in zip(params, param_types):
-                    if t == "int":
-                        converted_params.append(int(p))
-                    elif t == "float" or t == "double":
-                        converted_params.append(float(p))
-                    elif t == "string":
-                        converted_params.append(str(p))
-                    elif t == "bool":
-                        # 文字列 "true"/"false" で来るかどうかは要設計
-                        # ここでは Python の真偽値に変換する例
-                        converted_params.append(bool(p))
-                    elif t == "string[]":
-                        # p は配列前提
-                        if not isinstance(p, list):
-                            raise ValueError("Expected list of strings")
-                        str_list = [str(s) for s in p]
-                        converted_params.append(str_list)
-                    else:
-                        # それ以外は未対応としてエラー
-                        raise ValueError(f"Unsupported param type: {t}")
-            except Exception as e:
-                error_response = {
-                    "id": request_id,
-                    "error": f"Parameter type conversion error: {str(e)}"
-                }
-                client_socket.sendall(json.dumps(
-                    error_response).encode('utf-8'))
-                continue
-
-            # RPC 関数実行
-            func = RPC_METHODS[method]
-            try:
-                result = func(*converted_params)
-                # 結果の型を適宜判定 (細かくやるなら type(result) を見て分岐)
-                result_type_str = type(result).__name__
-
-                # JSON で送るため、list や bool などの場合も文字列化不要かもしれないが
-                # ここでは一律文字列にせず、そのまま JSON 化
-                response = {
-                    "results": result,
-                    "result_type": result_type_str,
-                    "id": request_id
-                }
-
-            except Exception as e:
-                # 関数内部でエラーが起きた場合
-                response = {
-                    "id": request_id,
-                    "error": str(e)
-                }
-
-            # クライアントに返却 (JSON 化)
-            client_socket.sendall(json.dumps(response).encode('utf-8'))
-
-
-def start_server(host='127.0.0.1', port=4000):
+    # 小さな応答フレームが Nagle で遅延しないようにする
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        # 空きスロットが出るまで新しいセッションは待たされる
+        async with _client_slots:
+            await _serve_session(reader, writer)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def _send_json(writer, obj):
+    """長さプレフィックスを付けて JSON を 1 フレーム送信する"""
+    body = json_dumps(obj)
+    writer.write(_FRAME_LEN.pack(len(body)))
+    writer.write(body)
+    await writer.drain()
+
+
+async def _serve_session(reader, writer):
+    """接続済みクライアント 1 つ分のリクエストループ"""
+    address = writer.get_extra_info('peername')
+    while True:
+        # 長さプレフィックスで正確に 1 リクエスト分を読み出す
+        try:
+            header = await reader.readexactly(_FRAME_LEN.size)
+            (body_len,) = _FRAME_LEN.unpack(header)
+            data = await reader.readexactly(body_len)
+        except asyncio.IncompleteReadError:
+            print(f"[INFO] Client disconnected: {address}")
+            break
+
+        # JSON をパース (bytes のまま渡せるので decode 不要)
+        try:
+            request = json_loads(data)
+        except ValueError as e:
+            # JSON が壊れている場合はエラー応答
+            error_response = {
+                "id": None,
+                "error": f"JSON decode error: {str(e)}"
+            }
+            await _send_json(writer, error_response)
+            continue
+
+        # リクエストから method / params / param_types / id を取得
+        method = request.get("method")
+        params = request.get("params", [])
+        param_types = request.get("param_types", [])
+        request_id = request.get("id")
+
+        # メソッドが辞書に存在するか確認
+        if method not in RPC_METHODS:
+            error_response = {
+                "id": request_id,
+                "error": f"Method '{method}' not found."
+            }
+            await _send_json(writer, error_response)
+            continue
+
+        # パラメータの型変換を行う (簡易的)
+        # strict=True で params と param_types の数の不一致も検出する
+        try:
+            converted_params = [
+                PARAM_CONVERTERS[t](p)
+                for p, t in zip(params, param_types, strict=True)
+            ]
+        except KeyError as e:
+            # 辞書に無い型名は未対応としてエラー
+            error_response = {
+                "id": request_id,
+                "error": f"Parameter type conversion error: "
+                         f"Unsupported param type: {e.args[0]}"
+            }
+            await _send_json(writer, error_response)
+            continue
+        except Exception as e:
+            error_response = {
+                "id": request_id,
+                "error": f"Parameter type conversion error: {str(e)}"
+            }
+            await _send_json(writer, error_response)
+            continue
+
+        # RPC 関数実行
+        func, result_type_str = RPC_METHODS[method]
+        try:
+            result = func(*converted_params)
+
+            # JSON で送るため、list や bool などの場合も文字列化不要かもしれないが
+            # ここでは一律文字列にせず、そのまま JSON 化
+            # (結果の型名はメソッドごとに固定なのでテーブルの値をそのまま使う)
+            response = {
+                "results": result,
+                "result_type": result_type_str,
+                "id": request_id
+            }
+
+        except Exception as e:
+            # 関数内部でエラーが起きた場合
+            response = {
+                "id": request_id,
+                "error": str(e)
+            }
+
+        # クライアントに返却 (JSON 化)
+        await _send_json(writer, response)
+
+
+async def start_server(host='127.0.0.1', port=4000):
     """サーバを起動し、クライアントからの接続を待受ける"""
+    global _client_slots
     print(f"[INFO] Starting RPC Server on {host}:{port}")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host, port))
-        server_socket.listen()
+    # クライアントごとに OS スレッドを立てる代わりに、単一スレッドの
+    # イベントループで全接続を多重化する (接続あたりのコストは
+    # スレッドスタック ~8MB からコルーチン数 KB に下がる)
+    _client_slots = asyncio.Semaphore(MAX_CONCURRENT_CLIENTS)
+    server = await asyncio.start_server(handle_client, host, port)
 
-        print("[INFO] Server listening for connections...")
+    print("[INFO] Server listening for connections...")
 
-        while True:
-            client_socket, address = server_socket.accept()
-            # スレッドで処理を並列化
-            thread = threading.Thread(
-                target=handle_client, args=(client_socket, address))
-            thread.daemon = True
-            thread.start()
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == "__main__":
-    start_server()
+    asyncio.run(start_server())
@@ -11,9 +11,6 @@ FILESIZE_HEADER_LEN = 32
 # ステータス応答 (16 バイト) を受け取る
 STATUS_MSG_LEN = 16
 
-# 1 パケットあたりの送信バイト数
-SEND_CHUNK_SIZE = 1400
-
 
 def main():
 
@@ -40,6 +37,11 @@ def main():
 
     # 3) TCP ソケットで接続
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # 大きなアップロードでカーネルバッファが詰まらないよう送受信
+        # バッファを 1MiB に広げ、小さなヘッダが Nagle で遅延しないようにする
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         s.connect((host, port))
 
         # 4) まず 32 バイトのヘッダを送信
@@ -49,15 +51,13 @@ def main():
             (FILESIZE_HEADER_LEN - 4)
         s.sendall(header)
 
-        # 5) ファイル本体を 1400 バイトずつ送信
-        sent_bytes = 0
+        # 5) ファイル本体を sendfile(2) でゼロコピー送信
+        #    (ページキャッシュから NIC へ直接流れ、Python 側の
+        #     read/sendall ループと中間バッファが丸ごと消える。
+        #     sendfile が使えない OS では socket.sendfile が内部で
+        #     通常送信にフォールバックする)
         with open(filename, 'rb') as f:
-            while True:
-                chunk = f.read(SEND_CHUNK_SIZE)
-                if not chunk:
-                    break
-                s.sendall(chunk)
-                sent_bytes += len(chunk)
+            sent_bytes = s.sendfile(f)
 
         print(f"[INFO] Finished sending {sent_bytes} bytes.")
 
@@ -73,14 +73,19 @@ def main():
 
 def recv_exact(sock, size):
     """
-    size バイトちょうど受信する
+    size バイトちょうど受信する。
+    bytes の += 連結 (受信のたびに再確保・コピーで O(n^2)) を避け、
+    確保済み bytearray へ recv_into で直接書き込む。
+    戻り値は bytearray (struct.unpack や decode にはそのまま使える)。
     """
-    buf = b''
-    while len(buf) < size:
-        chunk = sock.recv(size - len(buf))
-        if not chunk:
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    off = 0
+    while off < size:
+        n = sock.recv_into(mv[off:])
+        if not n:
             return None
-        buf += chunk
+        off += n
     return buf
 
 
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import socket
-import threading
 import struct
 import time
 import os
@@ -16,6 +16,15 @@ FILESIZE_HEADER_LEN = 32
 # 最終的にクライアントへ返すステータスメッセージのサイズ
 STATUS_MSG_LEN = 16
 
+# 1 回の読み出しで受け取る最大バイト数
+# (受信バッファ自体は StreamReader が接続ごとに 1 本の内部 bytearray を
+#  使い回すため、接続のたびにこちらでバッファを確保する必要はない)
+RECV_CHUNK_SIZE = 65536
+
+# ステータス応答は固定内容なので、接続ごとに encode + パディングせず
+# モジュール読み込み時に 1 回だけ組み立てておく
+STATUS_UPLOAD_OK = b'UPLOAD_OK'.ljust(STATUS_MSG_LEN, b'\x00')
+
 # 保存先ディレクトリ（実行時にカレントに作られる想定）
 UPLOAD_DIR = "uploads"
 
@@ -23,16 +32,27 @@ if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
 
-def handle_client(conn, addr):
+async def handle_client(reader, writer):
     """
     クライアント 1 台のファイル受信処理を行う
+    (スレッドではなくイベントループ上のコルーチンとして実行される)
     """
+    addr = writer.get_extra_info('peername')
     try:
         print(f"[INFO] Connected by {addr}")
 
+        # カーネルが大きなチャンクで届けられるよう送受信バッファを 1MiB に
+        # 広げ、16 バイトのステータス応答が Nagle で遅延しないようにする
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+
         # 1) まず 32 バイト受信
-        header_data = recv_exact(conn, FILESIZE_HEADER_LEN)
-        if not header_data:
+        try:
+            header_data = await reader.readexactly(FILESIZE_HEADER_LEN)
+        except asyncio.IncompleteReadError:
             print("[ERROR] Failed to receive file size header.")
             return
 
@@ -50,8 +70,8 @@ def handle_client(conn, addr):
         received_bytes = 0
         with open(out_filename, 'wb') as f:
             while received_bytes < file_size:
-                chunk_size = min(1400, file_size - received_bytes)
-                data = conn.recv(chunk_size)
+                data = await reader.read(
+                    min(RECV_CHUNK_SIZE, file_size - received_bytes))
                 if not data:
                     # 途中で切断されたらアップロード失敗
                     print("[ERROR] Connection lost during file upload.")
@@ -63,50 +83,34 @@ def handle_client(conn, addr):
               out_filename}, total={received_bytes} bytes")
 
         # 3) 16 バイトのステータスを返す (例: "UPLOAD_OK" + パディング)
-        status_str = "UPLOAD_OK"
-        status_bytes = status_str.encode('utf-8')
-        # 16 バイトにパディング
-        status_bytes_padded = status_bytes + b'\x00' * \
-            (STATUS_MSG_LEN - len(status_bytes))
-        conn.sendall(status_bytes_padded)
+        writer.write(STATUS_UPLOAD_OK)
+        await writer.drain()
 
     except Exception as e:
         print(f"[ERROR] {addr} - Exception: {e}")
     finally:
-        conn.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
         print(f"[INFO] Connection closed: {addr}")
 
 
-def recv_exact(conn, size):
-    """
-    size バイトを正確に受信するための補助関数
-    """
-    buf = b''
-    while len(buf) < size:
-        chunk = conn.recv(size - len(buf))
-        if not chunk:
-            return None
-        buf += chunk
-    return buf
-
-
-def main():
+async def main():
     print(f"=== File Upload Server (TCP) starting on port {PORT} ===")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen(BACKLOG)
-        print(f"[INFO] Listening on {HOST}:{PORT}")
+    # クライアントごとに OS スレッドを立てる代わりに、単一スレッドの
+    # イベントループで全接続を多重化する
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, backlog=BACKLOG)
+    print(f"[INFO] Listening on {HOST}:{PORT}")
 
-        try:
-            while True:
-                conn, addr = s.accept()
-                # クライアントごとにスレッドを立てて処理する
-                threading.Thread(target=handle_client, args=(
-                    conn, addr), daemon=True).start()
-        except KeyboardInterrupt:
-            print("\n[INFO] Server shutting down...")
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n[INFO] Server shutting down...")
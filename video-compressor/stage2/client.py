@@ -3,11 +3,30 @@
 
 import socket
 import struct
-import json
 import sys
 import os
 import time
 
+# JSON は orjson があればそちらを使う (bytes を直接返し、パース/
+# シリアライズとも速い)。無ければ標準ライブラリ json を
+# 同じインターフェース (bytes in / bytes out) に包んで使う
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)  # bytes を返す
+except ImportError:
+    import json
+
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
 MMP_HEADER_SIZE = 8
 
 """
@@ -15,6 +34,10 @@ MMP 送信時:
   ヘッダ(8バイト) = [2bytes:json_size][1byte:media_type_size][5bytes:payload_size]
   ボディ = [JSON (json_sizeバイト)] + [media_type (media_type_sizeバイト)] + [payload (payload_sizeバイト)]
 """
+# フォーマット文字列の再パースを払わないようモジュールスコープで
+# 一度だけコンパイルしておく (5 バイトの payload_size は int の
+# from_bytes/to_bytes で直接読み書きする)
+_MMP_HDR = struct.Struct('!HB5s')
 
 
 def main():
@@ -75,7 +98,7 @@ def main():
             "gif", "webm"] else "gif"
 
     # 送信前 JSON 作成
-    json_bytes = json.dumps(req_json).encode('utf-8')
+    json_bytes = json_dumps(req_json)
     json_size = len(json_bytes)
 
     # メディアタイプは拡張子から推定
@@ -85,28 +108,32 @@ def main():
     media_type_bytes = ext.encode('utf-8')
     media_type_size = len(media_type_bytes)
 
-    # ペイロード準備
-    with open(media_path, 'rb') as f:
-        file_data = f.read()
-    payload_size = len(file_data)
+    # ペイロードは全体をメモリへ読み込まず、サイズだけ先に調べておく
+    # (本体は送信時に sendfile でファイルから直接流す)
+    payload_size = os.path.getsize(media_path)
 
     # MMP ヘッダ作成
     #  [2bytes: json_size] [1byte: media_type_size] [5bytes: payload_size]
-    #  5 bytes of payload_size: we store it in 8 bytes then take the last 5
-    header_part1 = struct.pack('!HB', json_size, media_type_size)
-    payload_8 = struct.pack('!Q', payload_size)   # 64-bit
-    payload_5 = payload_8[3:]  # 後ろ5バイトを抽出
-    mmp_header = header_part1 + payload_5
+    #  5 バイトのビッグエンディアン整数は int.to_bytes で直接作る
+    mmp_header = _MMP_HDR.pack(json_size, media_type_size,
+                               payload_size.to_bytes(5, 'big'))
 
     # サーバへ送信
     print(f"[INFO] Connecting to {host}:{port}")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # 小さなヘッダが Nagle で遅延しないようにしつつ、ファイル本体の
+        # 送受信が既定のカーネルバッファで律速されないよう 1MiB に広げる
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
         s.connect((host, port))
-        # 送信
-        s.sendall(mmp_header)
-        s.sendall(json_bytes)
-        s.sendall(media_type_bytes)
-        s.sendall(file_data)
+        # 送信: ヘッダ + JSON + メディアタイプは 1 回の sendall にまとめ、
+        # 4 回の syscall と小さなセグメントの分割を避ける
+        s.sendall(b''.join((mmp_header, json_bytes, media_type_bytes)))
+        # ファイル本体は sendfile(2) でゼロコピー送信
+        # (巨大な MP4 でもピークメモリがファイルサイズ分増えない)
+        with open(media_path, 'rb') as f:
+            s.sendfile(f)
         print("[INFO] Request sent. Waiting for response...")
 
         # サーバ応答を受信: まずヘッダ (8バイト)
@@ -115,9 +142,9 @@ def main():
             print("[ERROR] No response header.")
             return
 
-        r_json_size, r_media_type_size = struct.unpack('!HB', resp_header[:3])
-        r_payload_size = struct.unpack(
-            '!Q', b'\x00\x00\x00' + resp_header[3:8])[0]
+        r_json_size, r_media_type_size, r_payload_size_bytes = \
+            _MMP_HDR.unpack(resp_header)
+        r_payload_size = int.from_bytes(r_payload_size_bytes, 'big')
 
         # JSON
         resp_json_bytes = recv_exact(
@@ -125,7 +152,7 @@ def main():
         resp_json = {}
         if resp_json_bytes:
             try:
-                resp_json = json.loads(resp_json_bytes.decode('utf-8'))
+                resp_json = json_loads(resp_json_bytes)
             except:
                 pass
 
@@ -158,14 +185,19 @@ def main():
 
 def recv_exact(sock, size):
     """
-    指定サイズを正確に受信する
+    指定サイズを正確に受信する。
+    bytes の += 連結 (受信のたびに再確保・コピーで O(n^2)) を避け、
+    確保済み bytearray へ recv_into で直接書き込む。
+    戻り値は bytearray (struct.unpack や decode にはそのまま使える)。
     """
-    buf = b''
-    while len(buf) < size:
-        chunk = sock.recv(size - len(buf))
-        if not chunk:
+    buf = bytearray(size)
+    mv = memoryview(buf)
+    off = 0
+    while off < size:
+        n = sock.recv_into(mv[off:])
+        if not n:
             return None
-        buf += chunk
+        off += n
     return buf
 
 
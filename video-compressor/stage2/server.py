@@ -1,15 +1,71 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import socket
-import threading
 import struct
-import json
 import subprocess
 import os
 import time
 import tempfile
 
+# JSON は orjson があればそちらを使う (bytes を直接返し、パース/
+# シリアライズとも速い)。無ければ標準ライブラリ json を
+# 同じインターフェース (bytes in / bytes out) に包んで使う
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)  # bytes を返す
+except ImportError:
+    import json
+
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# リクエストの JSON エンベロープからは数個のキーしか読まないので、
+# cysimdjson があれば遅延パース (dict を組み立てない) で読む。
+# パーサは内部バッファを使い回せるようモジュールスコープで 1 個だけ作る
+try:
+    import cysimdjson
+    _simd_parser = cysimdjson.JSONParser()
+except ImportError:
+    _simd_parser = None
+
+# リクエストエンベロープに現れうるキー
+_REQUEST_KEYS = ('operation', 'bitrate', 'width', 'height', 'aspect',
+                 'start', 'duration', 'output_format')
+
+
+def parse_request_info(json_bytes):
+    """
+    MMP リクエストの JSON エンベロープをパースして dict を返す。
+    cysimdjson が使える場合は既知のキーだけをポインタアクセスで
+    取り出す (全体の dict 構築をスキップする)。無ければ通常の
+    json_loads にフォールバックする。
+    """
+    if _simd_parser is not None:
+        try:
+            doc = _simd_parser.parse(json_bytes)
+            info = {}
+            for key in _REQUEST_KEYS:
+                try:
+                    info[key] = doc.at_pointer(f'/{key}')
+                except KeyError:
+                    pass
+            return info
+        except Exception:
+            # 壊れた JSON の扱い (例外の型とメッセージ) は
+            # 従来のパーサに任せる
+            pass
+    return json_loads(json_bytes)
+
 HOST = '0.0.0.0'
 PORT = 8000
 BACKLOG = 5
@@ -22,87 +78,123 @@ MMP_HEADER_SIZE = 8
   [1 byte: media_type_size (0~4)]
   [5 bytes: payload_size (0~1TB)]
 """
+# フォーマット文字列の再パースを払わないようモジュールスコープで
+# 一度だけコンパイルしておく (5 バイトの payload_size は int の
+# from_bytes/to_bytes で直接読み書きする)
+_MMP_HDR = struct.Struct('!HB5s')
+
+def _detect_h264_encoder():
+    """
+    利用できる H.264 ハードウェアエンコーダを起動時に一度だけ調べる。
+    (NVENC 等が使えると libx264 のソフトウェアエンコードより桁違いに速い)
+    """
+    try:
+        out = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            capture_output=True).stdout
+    except OSError:
+        return 'libx264'
+    for enc in (b'h264_nvenc', b'h264_videotoolbox',
+                b'h264_qsv', b'h264_vaapi'):
+        if enc in out:
+            return enc.decode('ascii')
+    return 'libx264'
+
+
+_H264_ENCODER = _detect_h264_encoder()
+# NVENC はプリセット体系が別 (p1=最速)。ソフトウェアエンコード時は
+# 既定の medium より大幅に速い veryfast を使う
+_H264_PRESET = 'p1' if 'nvenc' in _H264_ENCODER else 'veryfast'
+# 映像を再エンコードする操作に共通で付ける出力オプション
+_VIDEO_OUT_OPTS = [
+    '-c:v', _H264_ENCODER,
+    '-preset', _H264_PRESET,
+    '-threads', '0',
+    '-movflags', '+faststart',
+]
 
 # 同時処理制限: IP アドレス毎に1件のみ許可
 current_tasks = {}  # key=ip, value=bool (True=処理中)
 
-lock = threading.Lock()
+# イベントループは単一スレッドだが、await をまたぐ区間の
+# check-then-set を守るためにロックは残す
+lock = asyncio.Lock()
 
 
-def main():
+async def main():
     print(f"=== MMP Media Server running on {HOST}:{PORT} ===")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen(BACKLOG)
-        print("[INFO] Listening for connections...")
+    # クライアントごとに OS スレッドを立てる代わりに、単一スレッドの
+    # イベントループで全接続を多重化する (FFMPEG はサブプロセスなので
+    # 変換中もループはブロックされない)
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, backlog=BACKLOG)
+    print("[INFO] Listening for connections...")
 
-        try:
-            while True:
-                conn, addr = s.accept()
-                threading.Thread(target=handle_client, args=(
-                    conn, addr), daemon=True).start()
-        except KeyboardInterrupt:
-            print("\n[INFO] Server shutdown requested.")
+    async with server:
+        await server.serve_forever()
 
 
-def handle_client(conn, addr):
+async def handle_client(reader, writer):
     """
     クライアント1つのセッションを処理
     """
+    addr = writer.get_extra_info('peername')
     ip = addr[0]
     print(f"[INFO] Connected: {addr}")
-    with lock:
+    # 小さなヘッダ応答が Nagle で遅延しないようにしつつ、数 MB の
+    # アップロード/ダウンロードが既定のカーネルバッファで律速されない
+    # よう送受信バッファを 1MiB に広げる
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    input_path = None
+    output_path = None
+    async with lock:
         if current_tasks.get(ip, False):
             # すでにこの IP で処理中
-            send_mmp_error(conn, "ERR_CONCURRENT_TASK",
-                           "Another task is running", "Wait or cancel previous task")
-            conn.close()
+            await send_mmp_error(writer, "ERR_CONCURRENT_TASK",
+                                 "Another task is running",
+                                 "Wait or cancel previous task")
+            writer.close()
             return
         else:
             current_tasks[ip] = True
 
     try:
         # 1) MMP ヘッダ受信 (8バイト)
-        header = recv_exact(conn, MMP_HEADER_SIZE)
-        if not header:
+        try:
+            header = await reader.readexactly(MMP_HEADER_SIZE)
+        except asyncio.IncompleteReadError:
             print("[ERROR] No header received.")
             return
 
         # ヘッダ分解
         # 2 bytes: json_size (ushort), 1 byte: media_type_size, 5 bytes: payload_size
-        json_size, media_type_size = struct.unpack('!HB', header[:3])
-        payload_size = struct.unpack('!Q', b'\x00\x00\x00' + header[3:8])[0]
-        # 上のように 5 バイトを 8 バイトに拡張して 64bit (Q) で読み込む
-        #  b'\x00\x00\x00' + (5バイト) => 合計8バイト
+        json_size, media_type_size, payload_size_bytes = _MMP_HDR.unpack(
+            header)
+        # 5 バイトのビッグエンディアン整数は int.from_bytes で直接読む
+        # (ゼロ詰めの一時 bytes を作って 64bit 化する必要はない)
+        payload_size = int.from_bytes(payload_size_bytes, 'big')
 
         # 2) ボディ受信
-        # JSON 部分
-        json_bytes = recv_exact(conn, json_size)
-        if not json_bytes and json_size > 0:
-            print("[ERROR] JSON part not received fully.")
-            return
-
-        # メディアタイプ
-        media_type_bytes = recv_exact(conn, media_type_size)
-        if not media_type_bytes and media_type_size > 0:
-            print("[ERROR] MediaType part not received fully.")
-            return
-
-        # ペイロード
-        file_bytes = recv_exact(conn, payload_size)
-        if not file_bytes and payload_size > 0:
-            print("[ERROR] Payload not received fully.")
+        try:
+            # JSON 部分
+            json_bytes = await reader.readexactly(json_size)
+            # メディアタイプ
+            media_type_bytes = await reader.readexactly(media_type_size)
+        except asyncio.IncompleteReadError:
+            print("[ERROR] JSON/MediaType part not received fully.")
             return
 
-        # JSON パース
+        # JSON パース (bytes のまま渡せるので decode 不要)
         try:
-            json_str = json_bytes.decode('utf-8') if json_bytes else "{}"
-            request_info = json.loads(json_str)
+            request_info = parse_request_info(json_bytes) if json_bytes else {}
         except Exception as e:
             print("[ERROR] JSON parse error:", e)
-            send_mmp_error(conn, "ERR_JSON", "Invalid JSON format",
-                           "Check request JSON structure")
+            await send_mmp_error(writer, "ERR_JSON", "Invalid JSON format",
+                                 "Check request JSON structure")
             return
 
         # メディアタイプ
@@ -112,74 +204,111 @@ def handle_client(conn, addr):
         print(f"[DEBUG] JSON: {request_info}")
         print(f"[DEBUG] MediaType: {media_type}, payload_size={payload_size}")
 
-        # 3) 一時ファイルに保存
-        if payload_size > 0:
-            temp_input = tempfile.NamedTemporaryFile(
-                delete=False, suffix=f".{media_type}", prefix="input_", dir=".")
-            input_path = temp_input.name
-            temp_input.write(file_bytes)
-            temp_input.close()
+        # 3)+4) リクエストを処理 (FFMPEG)
+        operation = str(request_info.get("operation", "")).lower()
+        if payload_size > 0 and operation in PIPE_INPUT_OPERATIONS:
+            # 入力をシークしない操作は一時ファイルに書き戻さず、
+            # 受信したペイロードをそのまま ffmpeg の stdin へ流し込む
+            # (ディスク往復 2 回分を丸ごと省略)
+            try:
+                output_path = await process_media_from_stream(
+                    request_info, reader, payload_size, media_type)
+            except Exception as e:
+                print(f"[ERROR] FFMPEG process failed: {e}")
+                await send_mmp_error(writer, "ERR_FFMPEG",
+                                     "Failed to process media", str(e))
+                return
         else:
-            input_path = None
-
-        # 4) リクエストを処理 (FFMPEG)
-        output_path = None
-        try:
-            output_path = process_media(request_info, input_path)
-        except Exception as e:
-            print(f"[ERROR] FFMPEG process failed: {e}")
-            send_mmp_error(conn, "ERR_FFMPEG",
-                           "Failed to process media", str(e))
-            return
+            # gifwebm は -ss で入力をシークするため一時ファイルが必要。
+            # ペイロードはストリーミング受信しながら保存する
+            # (全体をメモリへ読み込まない。受信バッファは StreamReader が
+            #  接続ごとに 1 本の内部 bytearray を使い回すので、こちらで
+            #  バッファプールを持つ必要はない)
+            if payload_size > 0:
+                temp_input = tempfile.NamedTemporaryFile(
+                    delete=False, suffix=f".{media_type}", prefix="input_",
+                    dir=".")
+                input_path = temp_input.name
+                received = 0
+                while received < payload_size:
+                    data = await reader.read(
+                        min(65536, payload_size - received))
+                    if not data:
+                        print("[ERROR] Payload not received fully.")
+                        temp_input.close()
+                        return
+                    temp_input.write(data)
+                    received += len(data)
+                temp_input.close()
+            else:
+                input_path = None
+
+            try:
+                output_path = await process_media(request_info, input_path)
+            except Exception as e:
+                print(f"[ERROR] FFMPEG process failed: {e}")
+                await send_mmp_error(writer, "ERR_FFMPEG",
+                                     "Failed to process media", str(e))
+                return
 
         # 5) 処理結果ファイルを MMP 形式で返却
         if output_path and os.path.isfile(output_path):
             # 返すファイルの拡張子をメディアタイプにする (例: mp4, mp3, webm, gif etc.)
             out_ext = os.path.splitext(output_path)[1].lstrip(".")  # 例: "mp4"
-            with open(output_path, "rb") as f:
-                out_data = f.read()
 
             resp_json = {
                 "status": "OK",
                 "message": "Conversion done",
                 "operation": request_info.get("operation", "")
             }
-            resp_json_bytes = json.dumps(resp_json).encode('utf-8')
+            resp_json_bytes = json_dumps(resp_json)
             json_len = len(resp_json_bytes)
             out_type_bytes = out_ext.encode('utf-8')
             out_type_size = len(out_type_bytes)
-            payload_len = len(out_data)
+            # ファイルは読み込まずサイズだけ調べる (本体は sendfile で送る)
+            payload_len = os.path.getsize(output_path)
 
             # ヘッダ作成 (8バイト)
             # json_size (2bytes), media_type_size(1byte), payload_size(5bytes)
-            header = struct.pack('!HB', json_len, out_type_size)
-            # payload_size は 5 バイトに収まる形で作る
-            # → 先頭3バイト捨てた64bit(8byte)を構築
-            payload_5 = struct.pack('!Q', payload_len)[3:]  # 8バイトのうち後ろ5バイト
-            header += payload_5
+            header = _MMP_HDR.pack(json_len, out_type_size,
+                                   payload_len.to_bytes(5, 'big'))
 
             # 送信: ヘッダ + JSON + メディアタイプ + ファイルデータ
-            conn.sendall(header)
-            conn.sendall(resp_json_bytes)
-            conn.sendall(out_type_bytes)
-            conn.sendall(out_data)
+            writer.write(header)
+            writer.write(resp_json_bytes)
+            writer.write(out_type_bytes)
+            await writer.drain()
+            # ファイル本体は sendfile(2) でゼロコピー送信
+            # (全体を Python のバッファへ読み込まない。sendfile が
+            #  使えない環境ではイベントループが内部でフォールバック)
+            with open(output_path, "rb") as f:
+                await asyncio.get_running_loop().sendfile(writer.transport, f)
         else:
-            send_mmp_error(
-                conn, "ERR_NO_OUTPUT", "No output file was generated", "Check the FFMPEG parameters")
+            await send_mmp_error(
+                writer, "ERR_NO_OUTPUT", "No output file was generated",
+                "Check the FFMPEG parameters")
 
     finally:
         # クリーンアップ
-        with lock:
+        async with lock:
             current_tasks[ip] = False
         if input_path and os.path.exists(input_path):
             os.remove(input_path)
         if output_path and os.path.exists(output_path):
             os.remove(output_path)
-        conn.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
         print(f"[INFO] Disconnected: {addr}")
 
 
-def process_media(request_info, input_path):
+# 入力をシークしない操作 (stdin パイプから直接変換できる)
+PIPE_INPUT_OPERATIONS = {"compress", "resize", "aspect", "audio"}
+
+
+async def process_media(request_info, input_path):
     """
     FFMPEG を使ってメディアを変換し、出力ファイルパスを返す。
     request_info には operation, 各種パラメータ (width, height, aspect, start, duration, etc.) が入っている想定。
@@ -187,6 +316,100 @@ def process_media(request_info, input_path):
     if not input_path:
         raise ValueError("No input file provided.")
 
+    cmd, output_path = build_ffmpeg_cmd(request_info, input_path)
+
+    # FFMPEG 実行 (サブプロセス完了までイベントループをブロックしない)
+    print("[DEBUG] Running cmd:", " ".join(cmd))
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    _stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', errors='ignore'))
+
+    return output_path
+
+
+async def process_media_from_stream(request_info, reader, payload_size,
+                                    media_type=""):
+    """
+    受信中のペイロードを ffmpeg の stdin へそのままストリーミングして
+    変換する。出力ファイルパスを返す。
+
+    パイプ入力は moov が末尾にある (faststart でない) MP4 など、
+    シークできないと demux できないコンテナで失敗するため、
+    受信しながら一時ファイルにも書き溜めておき、ffmpeg が非 0 で
+    終了したら一時ファイル入力で再実行する (stage3 の
+    convert_to_mp3_encrypted と同じフォールバック)。
+    """
+    cmd, output_path = build_ffmpeg_cmd(request_info, 'pipe:0')
+
+    print("[DEBUG] Running cmd:", " ".join(cmd))
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+
+    # stderr は並行で読み続けないとパイプが詰まって双方が止まる
+    stderr_task = asyncio.ensure_future(proc.stderr.read())
+
+    # フォールバック用のスプール (受信とパイプ書き込みに相乗りするので
+    # 成功時の追加コストはローカル書き込み 1 回分だけ)
+    suffix = f".{media_type}" if media_type else ".bin"
+    spool = tempfile.NamedTemporaryFile(
+        delete=False, suffix=suffix, prefix="input_", dir=".")
+    spool_path = spool.name
+
+    try:
+        fed = 0
+        broken_pipe = False
+        while fed < payload_size:
+            data = await reader.read(min(65536, payload_size - fed))
+            if not data:
+                proc.kill()
+                await proc.wait()
+                raise RuntimeError("Payload not received fully")
+            spool.write(data)
+            if not broken_pipe:
+                try:
+                    proc.stdin.write(data)
+                    await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg 側が先に終了しても受信は最後まで続ける
+                    # (スプールが完成しないと再実行できない)
+                    broken_pipe = True
+            fed += len(data)
+        spool.close()
+        if not broken_pipe:
+            try:
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        stderr = await stderr_task
+        await proc.wait()
+        if proc.returncode == 0:
+            return output_path
+
+        # パイプ入力で失敗 → スプールした一時ファイルから再実行
+        print("[WARN] Pipe input failed, retrying with temp file:",
+              stderr.decode('utf-8', errors='ignore').strip()[-200:])
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return await process_media(request_info, spool_path)
+    finally:
+        spool.close()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+
+
+def build_ffmpeg_cmd(request_info, input_spec):
+    """
+    operation に応じた ffmpeg コマンドと出力ファイルパスを組み立てる。
+    input_spec は入力ファイルパスまたは 'pipe:0'。
+    """
     operation = request_info.get("operation", "").lower()
     if not operation:
         raise ValueError("No operation specified.")
@@ -216,8 +439,9 @@ def process_media(request_info, input_path):
         # 例: 単純にビットレートを落とす (800k) とか
         bitrate = request_info.get("bitrate", "800k")
         cmd = [
-            "ffmpeg", "-y", "-i", input_path,
+            "ffmpeg", "-y", "-i", input_spec,
             "-b:v", bitrate,
+            *_VIDEO_OUT_OPTS,
             output_path
         ]
     elif operation == "resize":
@@ -226,8 +450,9 @@ def process_media(request_info, input_path):
         height = request_info.get("height", 720)
         scale_str = f"{width}:{height}"
         cmd = [
-            "ffmpeg", "-y", "-i", input_path,
+            "ffmpeg", "-y", "-i", input_spec,
             "-vf", f"scale={scale_str}",
+            *_VIDEO_OUT_OPTS,
             output_path
         ]
     elif operation == "aspect":
@@ -236,14 +461,15 @@ def process_media(request_info, input_path):
         # scale で縦横どちらかを計算するか、あるいは setdar を使う等
         # 簡易的に setdar を使う例
         cmd = [
-            "ffmpeg", "-y", "-i", input_path,
+            "ffmpeg", "-y", "-i", input_spec,
             "-vf", f"setdar={aspect}",
+            *_VIDEO_OUT_OPTS,
             output_path
         ]
     elif operation == "audio":
         # 動画→音声抽出 (mp3)
         cmd = [
-            "ffmpeg", "-y", "-i", input_path,
+            "ffmpeg", "-y", "-i", input_spec,
             "-vn",   # no video
             "-acodec", "mp3",
             output_path
@@ -257,22 +483,16 @@ def process_media(request_info, input_path):
             "ffmpeg", "-y",
             "-ss", str(start),
             "-t", str(duration),
-            "-i", input_path,
+            "-i", input_spec,
             output_path
         ]
     else:
         raise ValueError(f"Unsupported operation: {operation}")
 
-    # FFMPEG 実行
-    print("[DEBUG] Running cmd:", " ".join(cmd))
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode != 0:
-        raise RuntimeError(proc.stderr.decode('utf-8', errors='ignore'))
+    return cmd, output_path
 
-    return output_path
 
-
-def send_mmp_error(conn, code, description, solution):
+async def send_mmp_error(writer, code, description, solution):
     """
     エラー時に JSON ({"error_code": code, "description":..., "solution":...}) を返す。
     MMP でメディアタイプサイズ＝0、ペイロードサイズ＝0 とする。
@@ -282,31 +502,24 @@ def send_mmp_error(conn, code, description, solution):
         "description": description,
         "solution": solution
     }
-    err_bytes = json.dumps(error_json).encode('utf-8')
+    err_bytes = json_dumps(error_json)
     json_len = len(err_bytes)
 
     # ヘッダ: [2bytes:json_size][1byte:media_type_size=0][5bytes:payload_size=0]
-    header = struct.pack('!HB', json_len, 0) + \
-        b'\x00\x00\x00\x00\x00'  # payload=0
+    header = _MMP_HDR.pack(json_len, 0, b'\x00\x00\x00\x00\x00')  # payload=0
 
-    conn.sendall(header)
-    conn.sendall(err_bytes)
+    writer.write(header)
+    writer.write(err_bytes)
     # media_type_size=0 → 送らない
     # payload_size=0 → 送らない
-
-
-def recv_exact(conn, size):
-    """
-    size バイト正確に受信するヘルパー
-    """
-    buf = b''
-    while len(buf) < size:
-        chunk = conn.recv(size - len(buf))
-        if not chunk:
-            return None
-        buf += chunk
-    return buf
+    try:
+        await writer.drain()
+    except OSError:
+        pass
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n[INFO] Server shutdown requested.")
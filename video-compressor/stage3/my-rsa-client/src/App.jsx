@@ -6,32 +6,27 @@ const AES_ALGORITHM = {
   length: 256,
 };
 
-// RSA-OAEP パラメータ
-const RSA_PARAMS = {
-  name: "RSA-OAEP",
-  modulusLength: 2048,
-  publicExponent: new Uint8Array([0x01, 0x00, 0x01]),
-  hash: { name: "SHA-256" },
-};
+// 鍵共有は X25519 (ECDH)。RSA-OAEP で AES 鍵をラップして送る方式より
+// 秘密鍵演算が 1〜2 桁速く、鍵そのものはネットワークに流れない
+const X25519_ALGORITHM = { name: "X25519" };
 
 function App() {
-  const [serverPubKeyPem, setServerPubKeyPem] = useState("");
+  const [serverPubKeyB64, setServerPubKeyB64] = useState("");
   const [clientKeyPair, setClientKeyPair] = useState(null);
   const [clientId, setClientId] = useState("user123");
   const [file, setFile] = useState(null);
   const [encryptedResult, setEncryptedResult] = useState(null);
-  const [encryptedKey, setEncryptedKey] = useState(null); // 新しいステート変数
-  const [aesKey, setAesKey] = useState(null);
+  const [serverEphPubKey, setServerEphPubKey] = useState(null); // サーバの応答用一時公開鍵
 
   // API サーバのベースURL
   const baseUrl = "http://localhost:8000";
 
-  // 1) サーバ公開鍵取得
+  // 1) サーバ公開鍵取得 (X25519 raw 32バイトの Base64)
   const fetchServerPubKey = async () => {
     try {
       const res = await fetch(`${baseUrl}/public-key`);
       const data = await res.json();
-      setServerPubKeyPem(data.serverPublicKey);
+      setServerPubKeyB64(data.serverPublicKey);
       alert("サーバ公開鍵を取得しました。");
     } catch (error) {
       console.error("Error fetching server public key:", error);
@@ -39,10 +34,10 @@ function App() {
     }
   };
 
-  // 2) クライアント側で RSA キーペア生成
+  // 2) クライアント側で X25519 キーペア生成
   const generateClientKeyPair = async () => {
     try {
-      const keyPair = await window.crypto.subtle.generateKey(RSA_PARAMS, true, ["encrypt", "decrypt"]);
+      const keyPair = await window.crypto.subtle.generateKey(X25519_ALGORITHM, true, ["deriveBits"]);
       setClientKeyPair(keyPair);
       alert("クライアント鍵ペアを生成しました。");
     } catch (error) {
@@ -58,16 +53,16 @@ function App() {
       return;
     }
     try {
-      // 公開鍵を SPKI 形式でエクスポートし、PEM化
-      const spki = await window.crypto.subtle.exportKey("spki", clientKeyPair.publicKey);
-      const pubPem = spkiToPem(spki);
+      // 公開鍵を raw (32バイト) でエクスポートして Base64 化
+      const rawPub = await window.crypto.subtle.exportKey("raw", clientKeyPair.publicKey);
+      const pubB64 = arrayBufferToBase64(rawPub);
 
       const res = await fetch(`${baseUrl}/client-public-key`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
           clientId,
-          publicKeyPem: pubPem,
+          publicKeyRaw: pubB64,
         }),
       });
       const data = await res.json();
@@ -91,18 +86,19 @@ function App() {
 
   // 5) 暗号化してアップロード
   const uploadEncrypted = async () => {
-    if (!serverPubKeyPem || !clientKeyPair || !file) {
+    if (!serverPubKeyB64 || !clientKeyPair || !file) {
       alert("サーバ公開鍵、クライアント鍵ペア、またはファイルが不足しています。");
       return;
     }
 
     try {
       // サーバ公開鍵を CryptoKey にインポート
-      const serverPublicKey = await importServerPublicKey(serverPubKeyPem);
+      const serverPublicKey = await importServerPublicKey(serverPubKeyB64);
 
-      // AES鍵を生成
-      const generatedAesKey = await window.crypto.subtle.generateKey(AES_ALGORITHM, true, ["encrypt", "decrypt"]);
-      setAesKey(generatedAesKey);
+      // このリクエスト専用の一時鍵ペアを生成し、サーバ公開鍵との
+      // 鍵共有 + HKDF で AES 鍵を導出する (鍵自体は送信しない)
+      const ephemeralKeyPair = await window.crypto.subtle.generateKey(X25519_ALGORITHM, true, ["deriveBits"]);
+      const derivedAesKey = await deriveAesGcmKey(ephemeralKeyPair.privateKey, serverPublicKey);
 
       // ファイルをArrayBufferで読み込み
       const fileData = await file.arrayBuffer();
@@ -114,46 +110,31 @@ function App() {
           name: "AES-GCM",
           iv: iv,
         },
-        generatedAesKey,
+        derivedAesKey,
         fileData
       );
 
-      // encryptedArrayBuffer は Ciphertext + Tag の組み合わせ
+      // encryptedArrayBuffer は WebCrypto がそのまま返す
+      // ciphertext || tag の連結 (NIST 形式) なので、切り出しは不要。
+      // ワイヤフォーマット: nonce(12) || ciphertext || tag(16) を
+      // バイナリ連結して base64 一段だけでエンコードする
+      // (JSON の中にさらに base64 を入れる二重ラップはしない)
       const encryptedDataBytes = new Uint8Array(encryptedArrayBuffer);
-      const ciphertextBytes = encryptedDataBytes.slice(0, encryptedDataBytes.length - 16);
-      const tagBytes = encryptedDataBytes.slice(encryptedDataBytes.length - 16);
-
-      // Base64エンコード
-      const ciphertextB64 = arrayBufferToBase64(ciphertextBytes.buffer);
-      const tagB64 = arrayBufferToBase64(tagBytes.buffer);
-      const ivB64 = arrayBufferToBase64(iv.buffer);
-
-      // AES鍵をエクスポートし、バイナリデータとして取得
-      const rawAesKey = await window.crypto.subtle.exportKey("raw", generatedAesKey);
-      // RSA-OAEPでAES鍵を暗号化
-      const encryptedAesKey = await window.crypto.subtle.encrypt(
-        {
-          name: "RSA-OAEP",
-        },
-        serverPublicKey,
-        rawAesKey
-      );
-      const encryptedKeyB64 = arrayBufferToBase64(encryptedAesKey);
+      const combined = new Uint8Array(12 + encryptedDataBytes.length);
+      combined.set(iv, 0);
+      combined.set(encryptedDataBytes, 12);
 
-      // encryptedData を JSON オブジェクトとして作成
-      const encryptedDataJson = JSON.stringify({
-        nonce: ivB64,
-        ciphertext: ciphertextB64,
-        tag: tagB64,
-      });
+      // 一時公開鍵を raw でエクスポートして Base64 化
+      const ephemeralPubRaw = await window.crypto.subtle.exportKey("raw", ephemeralKeyPair.publicKey);
+      const ephemeralPubB64 = arrayBufferToBase64(ephemeralPubRaw);
 
-      // JSON 文字列をBase64エンコード
-      const encryptedDataEncoded = arrayBufferToBase64(new TextEncoder().encode(encryptedDataJson));
+      // バイナリ連結を Base64 エンコード (一段のみ)
+      const encryptedDataEncoded = arrayBufferToBase64(combined.buffer);
 
       // サーバに送信するJSONデータ
       const payload = {
         clientId,
-        encryptedKey: encryptedKeyB64,
+        ephemeralPubKey: ephemeralPubB64,
         encryptedData: encryptedDataEncoded,
       };
 
@@ -168,7 +149,7 @@ function App() {
         alert("アップロードエラー: " + data.error);
       } else {
         setEncryptedResult(data.encryptedResult);
-        setEncryptedKey(data.encryptedKey); // encryptedKey を保存
+        setServerEphPubKey(data.ephemeralPubKey); // サーバの一時公開鍵を保存
         alert("サーバーからの暗号化済み結果を受信しました。");
       }
     } catch (error) {
@@ -179,48 +160,30 @@ function App() {
 
   // 6) 結果を復号しダウンロード
   const decryptResult = async () => {
-    if (!encryptedResult || !encryptedKey || !clientKeyPair) {
-      alert("暗号化された結果、暗号化キー、またはクライアント鍵ペアがありません。");
+    if (!encryptedResult || !serverEphPubKey || !clientKeyPair) {
+      alert("暗号化された結果、サーバの一時公開鍵、またはクライアント鍵ペアがありません。");
       return;
     }
 
     try {
-      // 暗号化されたAES鍵をBase64からArrayBufferに変換
-      const encryptedAesKeyBytes = base64ToArrayBuffer(encryptedKey);
-      // クライアント秘密鍵でAES鍵を復号
-      const decryptedAesKey = await window.crypto.subtle.decrypt(
-        {
-          name: "RSA-OAEP",
-        },
-        clientKeyPair.privateKey,
-        encryptedAesKeyBytes
-      );
-
-      // AES鍵をCryptoKeyオブジェクトにインポート
-      const aesKey = await window.crypto.subtle.importKey(
+      // サーバの一時公開鍵をインポートし、クライアント秘密鍵との
+      // 鍵共有 + HKDF で応答用 AES 鍵を導出する
+      const serverEphemeralKey = await window.crypto.subtle.importKey(
         "raw",
-        decryptedAesKey,
-        {
-          name: "AES-GCM",
-        },
-        true,
-        ["decrypt"]
+        base64ToArrayBuffer(serverEphPubKey),
+        X25519_ALGORITHM,
+        false,
+        []
       );
+      const aesKey = await deriveAesGcmKey(clientKeyPair.privateKey, serverEphemeralKey);
 
       // 暗号化された結果をBase64からArrayBufferに変換
-      const encryptedDataBytes = base64ToArrayBuffer(encryptedResult);
-
-      // encryptedDataBytes は Base64 デコード後の JSON 文字列
-      const encryptedDataJson = new TextDecoder().decode(encryptedDataBytes);
-      const encryptedData = JSON.parse(encryptedDataJson);
-      const nonce = base64ToArrayBuffer(encryptedData.nonce);
-      const ciphertext = base64ToArrayBuffer(encryptedData.ciphertext);
-      const tag = base64ToArrayBuffer(encryptedData.tag);
-
-      // ciphertextとtagを結合
-      const ciphertextWithTag = new Uint8Array(ciphertext.byteLength + tag.byteLength);
-      ciphertextWithTag.set(new Uint8Array(ciphertext), 0);
-      ciphertextWithTag.set(new Uint8Array(tag), ciphertext.byteLength);
+      // (nonce(12) || ciphertext || tag(16) のバイナリ連結)
+      // WebCrypto は ciphertext || tag の連結をそのまま受け取るので、
+      // nonce の後ろを切り出すだけで再結合は不要
+      const encryptedDataBytes = new Uint8Array(base64ToArrayBuffer(encryptedResult));
+      const nonce = encryptedDataBytes.slice(0, 12);
+      const ciphertextWithTag = encryptedDataBytes.slice(12);
 
       // AES-GCMでデータを復号
       const decryptedArrayBuffer = await window.crypto.subtle.decrypt(
@@ -254,13 +217,13 @@ function App() {
 
   return (
     <div style={{ margin: "1rem" }}>
-      <h1>RSA + ハイブリッド暗号化動画処理デモ</h1>
+      <h1>X25519 + ハイブリッド暗号化動画処理デモ</h1>
       <div>
         <button onClick={fetchServerPubKey}>1) サーバ公開鍵取得</button>
-        {serverPubKeyPem && (
+        {serverPubKeyB64 && (
           <div>
-            <h3>サーバ公開鍵:</h3>
-            <pre>{serverPubKeyPem}</pre>
+            <h3>サーバ公開鍵 (X25519, Base64):</h3>
+            <pre>{serverPubKeyB64}</pre>
           </div>
         )}
       </div>
@@ -280,7 +243,7 @@ function App() {
       </div>
       <hr />
       <div>
-        <button onClick={decryptResult} disabled={!encryptedResult || !encryptedKey}>
+        <button onClick={decryptResult} disabled={!encryptedResult || !serverEphPubKey}>
           5) 結果を復号しダウンロード
         </button>
       </div>
@@ -292,34 +255,36 @@ function App() {
 // ユーティリティ関数
 // ============================================================
 
-// PEM形式の公開鍵を CryptoKey にインポート
-async function importServerPublicKey(pem) {
-  const pemHeader = "-----BEGIN PUBLIC KEY-----";
-  const pemFooter = "-----END PUBLIC KEY-----";
-  const pemContents = pem
-    .substring(pem.indexOf(pemHeader) + pemHeader.length, pem.indexOf(pemFooter))
-    .replace(/\s/g, "");
-  const binaryDer = base64ToArrayBuffer(pemContents);
-
+// Base64 (raw 32バイト) のサーバ X25519 公開鍵を CryptoKey にインポート
+async function importServerPublicKey(b64) {
   return await window.crypto.subtle.importKey(
-    "spki",
-    binaryDer,
+    "raw",
+    base64ToArrayBuffer(b64),
+    { name: "X25519" },
+    false,
+    []
+  );
+}
+
+// X25519 の鍵共有と HKDF-SHA256 で AES-GCM 鍵を導出する
+// (サーバ側の derive_aes_key と同じパラメータ: salt なし, info="aes-gcm")
+async function deriveAesGcmKey(privateKey, publicKey) {
+  const sharedSecret = await window.crypto.subtle.deriveBits({ name: "X25519", public: publicKey }, privateKey, 256);
+  const hkdfKey = await window.crypto.subtle.importKey("raw", sharedSecret, "HKDF", false, ["deriveKey"]);
+  return await window.crypto.subtle.deriveKey(
     {
-      name: "RSA-OAEP",
+      name: "HKDF",
       hash: "SHA-256",
+      salt: new Uint8Array(0),
+      info: new TextEncoder().encode("aes-gcm"),
     },
-    true,
-    ["encrypt"]
+    hkdfKey,
+    AES_ALGORITHM,
+    false,
+    ["encrypt", "decrypt"]
   );
 }
 
-// SPKIバイナリを PEM形式に変換
-function spkiToPem(spki) {
-  const b64 = arrayBufferToBase64(spki);
-  const pem = `-----BEGIN PUBLIC KEY-----\n${b64.match(/.{1,64}/g).join("\n")}\n-----END PUBLIC KEY-----\n`;
-  return pem;
-}
-
 // ArrayBuffer を Base64に変換
 function arrayBufferToBase64(buffer) {
   const bytes = new Uint8Array(buffer);
@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import base64
-import json
+import asyncio
+import collections
+import fcntl
+import mmap
 import os
-import subprocess
+import ssl
 import tempfile
+import threading
 
-from fastapi import FastAPI
+# base64 モジュールは binascii の上の純 Python ラッパなので、
+# ホットパスでは下の C 関数を直接呼ぶ
+# (b2a_base64 は newline=False で標準の b64encode と同じ出力になる)
+from binascii import a2b_base64, b2a_base64
+
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from typing import Optional
 
-# cryptography ライブラリ (RSA と AES を扱う)
+# cryptography ライブラリ (X25519 と AES を扱う)
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 # CORS ミドルウェアをインポート
 from fastapi.middleware.cors import CORSMiddleware
@@ -33,22 +42,50 @@ class ClientPublicKeyModel(BaseModel):
     クライアントから公開鍵を送信する際に使うデータモデル
     """
     clientId: str
-    publicKeyPem: str
+    publicKeyRaw: str  # X25519 公開鍵 (32バイト) の Base64 文字列
 
 
 class EncryptedUploadModel(BaseModel):
     """
-    クライアントから暗号化された共通鍵とデータをアップロードする際のデータモデル
+    クライアントから鍵共有用の一時公開鍵と暗号化データを
+    アップロードする際のデータモデル
     """
     clientId: str
-    encryptedKey: str  # Base64 文字列
-    encryptedData: str  # Base64 文字列（Base64エンコードされたJSON形式）
+    # クライアントがこのリクエスト用に生成した X25519 一時公開鍵
+    # (32バイト) の Base64 文字列。サーバはこれと自身の秘密鍵の
+    # ECDH + HKDF で AES 鍵を導出する (RSA で鍵そのものを
+    # ラップして送る方式は廃止)
+    ephemeralPubKey: str
+    # Base64 文字列。デコード後は nonce(12) || ciphertext || tag(16) の
+    # バイナリ連結。ciphertext||tag は AEAD API がそのまま受け渡す
+    # NIST の連結形式なので、タグの切り出し・並べ替えが不要
+    # (以前の「Base64 エンコードされた JSON の中にさらに Base64
+    # フィールド」という二重ラップは、100MB 級のペイロードで +33% の
+    # サイズと余分なメモリパスになるため廃止)
+    encryptedData: str
+
+
+class BatchUploadModel(BaseModel):
+    """
+    複数のアップロードを 1 リクエストにまとめるデータモデル
+    """
+    items: list[EncryptedUploadModel]
 
 
 # ============================================================
 # FastAPI アプリケーション本体
 # ============================================================
-app = FastAPI()
+
+# レスポンスの JSON 化は orjson があればそちらを使う (C 実装で
+# bytes を直接書き出すため、数 MB の base64 文字列を含むレスポンス
+# でも標準 json の 3〜10 倍速い)。無ければ標準の JSONResponse
+try:
+    from fastapi.responses import ORJSONResponse as _JSONResponse
+    import orjson  # noqa: F401  (ORJSONResponse の実体が必要とする)
+except ImportError:
+    from fastapi.responses import JSONResponse as _JSONResponse
+
+app = FastAPI(default_response_class=_JSONResponse)
 
 # CORS 設定
 origins = [
@@ -64,119 +101,445 @@ app.add_middleware(
     allow_headers=["*"],             # 許可するHTTPヘッダー（全て）
 )
 
-# サーバ起動時に RSA 鍵ペア（サーバ用）を作成
-# ※ 実運用ではファイルに保存し、再起動時に読み込むことを推奨
-server_private_key = rsa.generate_private_key(
-    public_exponent=65537,
-    key_size=2048
-)
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    ボディサイズの上限をパース前に強制する。エンドポイント内の
+    チェックでは pydantic がボディ全体を読み込んだ後になるため、
+    巨大なボディでメモリを食い潰される。ここで Content-Length を
+    見て弾き、ヘッダの無い chunked リクエストは受信量を数えて
+    上限超過で中断する。
+    """
+    if request.method == "POST":
+        content_length = request.headers.get("content-length")
+        if content_length is not None:
+            try:
+                if int(content_length) > MAX_UPLOAD_BYTES:
+                    return _JSONResponse(
+                        {"error": "Payload too large"}, status_code=413)
+            except ValueError:
+                return _JSONResponse(
+                    {"error": "Invalid Content-Length"}, status_code=400)
+        else:
+            received = 0
+            original_receive = request._receive
+
+            async def limited_receive():
+                nonlocal received
+                message = await original_receive()
+                if message["type"] == "http.request":
+                    received += len(message.get("body", b""))
+                    if received > MAX_UPLOAD_BYTES:
+                        raise HTTPException(
+                            status_code=413, detail="Payload too large")
+                return message
+
+            request._receive = limited_receive
+    return await call_next(request)
+
+# サーバ用 X25519 鍵ペアはファイルに永続化して共有する。
+# インポートのたびに生成すると uvicorn を --workers N で動かした際に
+# ワーカーごとに別の鍵になってしまい、別ワーカーの公開鍵と鍵共有した
+# クライアントのリクエストが壊れる
+SERVER_KEY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "server_key.pem")
+
+
+def _load_or_create_server_key():
+    """
+    鍵ファイルがあれば読み込み、無ければ生成して原子的に書き出す。
+    flock で排他するので複数ワーカーが同時に起動しても
+    生成するのは 1 ワーカーだけ。
+    """
+    with open(SERVER_KEY_PATH + ".lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(SERVER_KEY_PATH):
+                with open(SERVER_KEY_PATH, "rb") as f:
+                    key = serialization.load_pem_private_key(
+                        f.read(), password=None)
+                # 旧バージョンの RSA 鍵ファイルが残っている場合は
+                # X25519 鍵として作り直す
+                if isinstance(key, x25519.X25519PrivateKey):
+                    return key
+
+            key = x25519.X25519PrivateKey.generate()
+            pem = key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            # 書きかけのファイルを他ワーカーが読まないよう tmp に書いて rename
+            tmp_path = SERVER_KEY_PATH + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(pem)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, SERVER_KEY_PATH)
+            return key
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+server_private_key = _load_or_create_server_key()
 server_public_key = server_private_key.public_key()
 
-# クライアントごとの公開鍵を保持するための辞書
+# 公開鍵のエンコードは決定的でプロセス生存中に変わらないので、
+# リクエストごとに public_bytes + base64 を回さずここで 1 回だけ行う
+_SERVER_PUB_B64 = b2a_base64(
+    server_public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw),
+    newline=False).decode('ascii')
+
+# クライアントごとの公開鍵を保持する LRU 辞書
 #   key: clientId (str)
-#   value: 公開鍵オブジェクト (cryptography.hazmat.primitives.asymmetric.rsa.RSAPublicKey)
-client_public_keys = {}
+#   value: パース済み公開鍵オブジェクト
+#          (cryptography.hazmat.primitives.asymmetric.x25519.X25519PublicKey)
+# 登録 (/client-public-key) と参照 (/upload-encrypted) が並行に走るので
+# ロックで守り、野放図に増えないよう上限を超えたら最古のものから捨てる
+client_public_keys = collections.OrderedDict()
+_CLIENT_KEYS_MAX = 10000
+_client_keys_lock = threading.Lock()
+
+
+def _remember_client_key(client_id: str, pubkey) -> None:
+    """クライアント公開鍵を LRU 辞書に登録する"""
+    with _client_keys_lock:
+        client_public_keys[client_id] = pubkey
+        client_public_keys.move_to_end(client_id)
+        while len(client_public_keys) > _CLIENT_KEYS_MAX:
+            client_public_keys.popitem(last=False)
+
+
+def _lookup_client_key(client_id: str):
+    """クライアント公開鍵を引く (あれば最近使った扱いにする)"""
+    with _client_keys_lock:
+        pubkey = client_public_keys.get(client_id)
+        if pubkey is not None:
+            client_public_keys.move_to_end(client_id)
+        return pubkey
 
 
 # ============================================================
 # ハイブリッド暗号化のヘルパー関数
 # ============================================================
-def decrypt_aes_key(encrypted_key: bytes) -> bytes:
-    """
-    RSA-OAEPで暗号化されたAES鍵を復号します。
-    """
-    aes_key = server_private_key.decrypt(
-        encrypted_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    return aes_key
+
+# AES-GCM は OpenSSL の EVP 経由 (AES-NI + PCLMULQDQ) で処理される。
+# no-asm ビルドの OpenSSL や OPENSSL_ia32cap で AES-NI をマスクした
+# 環境ではソフトウェア実装に落ちて 10 倍以上遅くなるので、起動時に
+# リンク先の OpenSSL を確認できるようログに出しておく
+print(f"[INFO] OpenSSL: {ssl.OPENSSL_VERSION}")
+if os.environ.get("OPENSSL_ia32cap"):
+    print("[WARN] OPENSSL_ia32cap is set; AES-NI may be masked: "
+          f"{os.environ['OPENSSL_ia32cap']}")
 
 
-def encrypt_aes_key(aes_key: bytes, client_pubkey) -> bytes:
+def _cpu_has_aes_acceleration() -> bool:
+    """
+    CPU に AES 命令 (x86 の AES-NI / ARM の AES 拡張) があるか調べる。
+    Linux では /proc/cpuinfo のフラグに x86 / aarch64 とも "aes" が
+    載る。判定できない環境では True とみなす (警告を出さないだけ)。
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return "aes" in line.split()
+    except OSError:
+        pass
+    return True
+
+
+# AES 命令の無い CPU (古い Atom/Celeron や一部 ARM) では AES-GCM が
+# ビットスライスのソフトウェア実装になり ~5 倍遅い。その場合は
+# ChaCha20-Poly1305 の方が速いが、対向のブラウザ (WebCrypto) が
+# ChaCha20-Poly1305 を実装していないためワイヤ上の AEAD は
+# AES-GCM から変えられない。起動時に分かるよう警告だけ出しておく
+if not _cpu_has_aes_acceleration():
+    print("[WARN] CPU lacks AES acceleration; AES-GCM will run in "
+          "software (~5x slower). ChaCha20-Poly1305 would be faster "
+          "but the WebCrypto client cannot use it.")
+
+# HKDF のドメイン分離用 info (クライアント側と合わせること)
+_HKDF_INFO = b"aes-gcm"
+
+# ハッシュアルゴリズムのインスタンスは状態を持たないので、
+# 導出のたびに作らずモジュールスコープの 1 個を使い回す
+_HKDF_HASH = hashes.SHA256()
+
+
+def derive_aes_key(private_key, peer_public_key) -> bytes:
     """
-    AES鍵をクライアントの公開鍵でRSA-OAEPを用いて暗号化します。
+    X25519 の鍵共有と HKDF-SHA256 で 256 ビットの AES 鍵を導出します。
+    RSA-2048 の秘密鍵演算 (~1-2ms) と違い、数十 µs で済む。
     """
-    encrypted_aes_key = client_pubkey.encrypt(
-        aes_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    return encrypted_aes_key
+    shared_secret = private_key.exchange(peer_public_key)
+    return HKDF(
+        algorithm=_HKDF_HASH,
+        length=32,
+        salt=None,
+        info=_HKDF_INFO
+    ).derive(shared_secret)
 
 
-def decrypt_data_aes(aes_key: bytes, nonce: bytes, ciphertext: bytes, tag: bytes) -> bytes:
+def decrypt_data_aes(aes_key: bytes, nonce: bytes,
+                     ciphertext_with_tag: bytes) -> bytes:
     """
     AES-GCMモードでデータを復号します。
+    one-shot の AESGCM API (OpenSSL EVP 直結, AES-NI + PCLMULQDQ に
+    ディスパッチされる) を使う。API はタグが ciphertext の末尾に
+    連結された NIST の形式を受けるので、ワイヤ上の
+    ciphertext || tag をそのまま (memoryview のままでも) 渡せる。
     """
-    decryptor = Cipher(
-        algorithms.AES(aes_key),
-        modes.GCM(nonce, tag),
-        backend=default_backend()
-    ).decryptor()
-    plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-    return plaintext
+    # 鍵はリクエストごとの ECDH で導出する一期一会のものなので、
+    # コンテキストはキャッシュせず毎回構築して鍵材料を残さない
+    return AESGCM(aes_key).decrypt(nonce, ciphertext_with_tag, None)
 
 
-def encrypt_data_aes(aes_key: bytes, plaintext: bytes) -> dict:
+def encrypt_data_aes(aes_key: bytes, plaintext: bytes) -> bytes:
     """
     AES-GCMモードでデータを暗号化します。
-    戻り値は辞書形式で、`nonce`, `ciphertext`, `tag` を含みます。
+    戻り値は nonce(12) || ciphertext || tag(16) のバイナリ連結。
+    AESGCM.encrypt が ciphertext || tag を連結して返すので、
+    nonce を前置するだけで並べ替えは不要。
     """
     nonce = os.urandom(12)  # 96ビットのnonce
-    encryptor = Cipher(
-        algorithms.AES(aes_key),
-        modes.GCM(nonce),
-        backend=default_backend()
-    ).encryptor()
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
-    return {
-        "nonce": base64.b64encode(nonce).decode('utf-8'),
-        "ciphertext": base64.b64encode(ciphertext).decode('utf-8'),
-        "tag": base64.b64encode(encryptor.tag).decode('utf-8')
-    }
+    return b''.join((nonce, AESGCM(aes_key).encrypt(nonce, plaintext, None)))
 
 
 # ============================================================
 # FFmpeg で MP3 に変換する関数
 # ============================================================
-def do_ffmpeg_convert_to_mp3(input_path: str) -> str:
-    """
-    FFmpegを使って入力動画から音声を抽出し、
-    MP3ファイルを生成して返す。
-    """
-    # 出力用の一時ファイルを作成
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-        output_path = tmp.name
-
-    # ffmpeg コマンド:
-    #  -vn        : 映像を無視
-    #  -acodec mp3: 音声を mp3 でエンコード
-    #  -b:a 128k  : 音声ビットレートを128kbpsに設定
-    cmd = [
-        "ffmpeg",
-        "-y",            # 上書き
-        "-i", input_path,
-        "-vn",           # 動画無視
-        "-acodec", "mp3",
-        "-b:a", "128k",  # ビットレート設定
-        output_path
-    ]
-
-    # 実行
-    proc = subprocess.run(cmd, capture_output=True)
-    if proc.returncode != 0:
-        # エラー発生時、stderr を表示するなど
-        error_msg = proc.stderr.decode("utf-8", errors="ignore")
-        raise RuntimeError(f"FFmpeg failed: {error_msg}")
-
-    return output_path
+# ストリーミング暗号化のチャンクサイズ。32KiB 程度だと呼び出し
+# オーバーヘッドの比率が大きく、L2 に収まる 256KiB 前後が良い
+_AES_STREAM_CHUNK = 256 * 1024
+
+# 1 リクエストで受け付けるペイロードの上限。復号前の base64 文字列に
+# 上限が無いと、巨大なボディを送り付けるだけで認証前に OOM させられる
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+
+# フォールバックの一時ファイルは tmpfs (/dev/shm) に置く。
+# RAM 上で完結するので、復号済み動画をディスクへ書いて読み戻す
+# 往復がメモリ帯域の操作になる (Linux 以外では既定の $TMPDIR)
+_TMPFILE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+async def _feed_stdin(proc, data: bytes):
+    """サブプロセスの stdin へデータを流し込んで閉じる"""
+    mv = memoryview(data)
+    try:
+        for offset in range(0, len(mv), 65536):
+            proc.stdin.write(mv[offset:offset + 65536])
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg が先に終了した場合 (エラーは returncode で拾う)
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# ffmpeg コマンド (パイプ変換用):
+#  -hide_banner -loglevel error : 起動ログと stderr バッファを削る
+#  -threads 0      : スレッド数をコア数に合わせて自動設定
+#  -i pipe:0       : 入力を stdin から読む
+#  -vn -map 0:a:0? : 映像を無視し、最初の音声ストリームだけ選択
+#                    (ビデオデコーダをパイプラインから外す)
+#  -c:a libmp3lame : 音声を mp3 でエンコード
+#  -b:a 128k       : 音声ビットレートを128kbpsに設定
+#  -f mp3 pipe:1   : 出力フォーマットを明示して stdout へ書く
+#                    (パイプ出力では拡張子からの推定ができない)
+_FFMPEG_PIPE_CMD = [
+    "ffmpeg",
+    "-hide_banner",
+    "-loglevel", "error",
+    "-y",            # 上書き
+    "-threads", "0",
+    "-i", "pipe:0",
+    "-vn",           # 動画無視
+    "-map", "0:a:0?",
+    "-c:a", "libmp3lame",
+    "-b:a", "128k",  # ビットレート設定
+    "-f", "mp3",
+    "pipe:1"
+]
+
+# ffmpeg は nice を上げ、CPU 0 をイベントループ (uvicorn) に残した
+# CPU セットで動かす。エンコードが全コアを食い潰して accept や
+# /public-key などの小さなリクエストのテールレイテンシが伸びるのを防ぐ
+_FFMPEG_NICENESS = 10
+_cpu_total = os.cpu_count() or 1
+_FFMPEG_CPUS = set(range(1, _cpu_total)) if _cpu_total > 1 else None
+
+
+def _ffmpeg_preexec():
+    """fork 直後の子プロセス側で優先度と CPU アフィニティを下げる"""
+    os.nice(_FFMPEG_NICENESS)
+    if _FFMPEG_CPUS and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, _FFMPEG_CPUS)
+        except OSError:
+            pass
+
+
+# 事前起動しておく ffmpeg プロセスの数。起動した ffmpeg は stdin を
+# 読むまでブロックして待つので、fork/exec + リンカ + コーデック表の
+# 初期化 (~100ms) をリクエスト到着前に済ませておける。
+# プロセスは 1 ジョブ使い切りで、取り出すたびに裏で補充する
+_FFMPEG_POOL_SIZE = min(4, os.cpu_count() or 1)
+_ffmpeg_pool = None  # app 起動時に asyncio.Queue として初期化
+
+
+async def _spawn_ffmpeg():
+    """パイプ変換用の ffmpeg プロセスを 1 つ起動する"""
+    return await asyncio.create_subprocess_exec(
+        *_FFMPEG_PIPE_CMD, stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        preexec_fn=_ffmpeg_preexec)
+
+
+async def _replenish_ffmpeg_pool():
+    """プールへ ffmpeg プロセスを 1 つ補充する"""
+    _ffmpeg_pool.put_nowait(await _spawn_ffmpeg())
+
+
+async def _checkout_ffmpeg():
+    """
+    事前起動済みの ffmpeg プロセスを取り出す (空なら新規起動)。
+    取り出した分の補充はバックグラウンドで行い、リクエストを待たせない。
+    """
+    if _ffmpeg_pool is None or _ffmpeg_pool.empty():
+        return await _spawn_ffmpeg()
+    proc = _ffmpeg_pool.get_nowait()
+    asyncio.ensure_future(_replenish_ffmpeg_pool())
+    return proc
+
+
+@app.on_event("startup")
+async def _warm_ffmpeg_pool():
+    global _ffmpeg_pool
+    _ffmpeg_pool = asyncio.Queue()
+    for _ in range(_FFMPEG_POOL_SIZE):
+        await _replenish_ffmpeg_pool()
+
+
+@app.on_event("shutdown")
+async def _drain_ffmpeg_pool():
+    while _ffmpeg_pool is not None and not _ffmpeg_pool.empty():
+        proc = _ffmpeg_pool.get_nowait()
+        proc.kill()
+        await proc.wait()
+
+
+async def convert_to_mp3_encrypted(plaintext: bytes, aes_key: bytes) -> bytes:
+    """
+    FFmpegで入力動画から音声を抽出し、MP3 を AES-GCM で暗号化した
+    nonce(12) || ciphertext || tag(16) を返す。
+    入力は stdin (pipe:0)、出力は stdout (pipe:1) で受け渡し、stdout を
+    256KiB ずつ encryptor.update に流し込むので、MP3 平文の全体と
+    暗号文の全体を同時に持つことがない (ピーク RSS がほぼ半減する)。
+    変換中はイベントループをブロックしないよう asyncio の
+    サブプロセスとして await する。
+    """
+    # fork/exec 済みのプロセスをプールから取り出す
+    proc = await _checkout_ffmpeg()
+
+    # ストリーミング用の低レベル GCM encryptor (update も EVP 経由で
+    # AES-NI にディスパッチされる。one-shot API はストリームに使えない)
+    nonce = os.urandom(12)
+    encryptor = Cipher(
+        algorithms.AES(aes_key), modes.GCM(nonce)).encryptor()
+
+    # stdin への書き込みと stdout の読み出しを並行させる
+    # (片方ずつだとパイプバッファが埋まってデッドロックする)
+    feeder = asyncio.ensure_future(_feed_stdin(proc, plaintext))
+    stderr_task = asyncio.ensure_future(proc.stderr.read())
+
+    # 先頭に nonce を置き、暗号文チャンクを追記していく
+    # (タグは finalize 後に末尾へ連結する)
+    parts = [nonce]
+    while True:
+        chunk = await proc.stdout.read(_AES_STREAM_CHUNK)
+        if not chunk:
+            break
+        parts.append(encryptor.update(chunk))
+
+    await feeder
+    await stderr_task
+    if await proc.wait() != 0:
+        # stdin からストリーム復号できないコンテナ (moov が末尾にある
+        # mp4 など) は一時ファイル経由でリトライする
+        # (途中まで進んだ encryptor は finalize せず破棄する)
+        return await _convert_to_mp3_encrypted_tempfile(plaintext, aes_key)
+
+    encryptor.finalize()
+    parts.append(encryptor.tag)
+    return b''.join(parts)
+
+
+async def _convert_to_mp3_encrypted_tempfile(plaintext: bytes,
+                                             aes_key: bytes) -> bytes:
+    """
+    パイプ入力で変換できなかった場合のフォールバック。
+    入力をシーク可能な一時ファイルに書き出してから変換し、
+    出力ファイルを mmap で参照したまま暗号化する
+    (全体を read() でヒープに読み込むコピーを 1 回省く)。
+    """
+    input_path = ""
+    output_path = ""
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4",
+                                         dir=_TMPFILE_DIR) as tmp:
+            input_path = tmp.name
+            tmp.write(plaintext)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3",
+                                         dir=_TMPFILE_DIR) as tmp:
+            output_path = tmp.name
+
+        # ファイル入力なので -nostdin で stdin を切っておく
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-nostdin",
+            "-y",
+            "-threads", "0",
+            "-i", input_path,
+            "-vn",
+            "-map", "0:a:0?",
+            "-c:a", "libmp3lame",
+            "-b:a", "128k",
+            output_path
+        ]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_ffmpeg_preexec)
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            # エラー発生時、stderr を表示するなど
+            error_msg = stderr.decode("utf-8", errors="ignore")
+            raise RuntimeError(f"FFmpeg failed: {error_msg}")
+
+        # 出力ファイルはヒープへ読み込まず mmap で直接 AEAD に渡す
+        # (AEAD は buffer protocol を受けるのでコピーは暗号文側のみ)
+        sz = os.path.getsize(output_path)
+        if sz == 0:
+            return encrypt_data_aes(aes_key, b'')
+        with open(output_path, "rb") as fin:
+            mv = mmap.mmap(fin.fileno(), sz, prot=mmap.PROT_READ)
+            try:
+                return encrypt_data_aes(aes_key, mv)
+            finally:
+                mv.close()
+    finally:
+        if input_path and os.path.exists(input_path):
+            os.remove(input_path)
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
 
 
 # ============================================================
@@ -186,133 +549,151 @@ def do_ffmpeg_convert_to_mp3(input_path: str) -> str:
 @app.get("/public-key")
 def get_server_public_key():
     """
-    サーバの公開鍵を PEM 形式で返す。
-    クライアントはこの鍵を使ってAES鍵を暗号化します。
+    サーバの X25519 公開鍵 (raw 32バイト) を Base64 で返す。
+    クライアントはこの鍵と一時鍵の鍵共有で AES 鍵を導出します。
+    エンコード済みの文字列はモジュール読み込み時に 1 回だけ作ってある。
     """
-    # 公開鍵を PEM (SubjectPublicKeyInfo) としてエンコード
-    pub_bytes = server_public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-    return {"serverPublicKey": pub_bytes.decode("utf-8")}
+    return {"serverPublicKey": _SERVER_PUB_B64}
 
 
 @app.post("/client-public-key")
 def set_client_public_key(data: ClientPublicKeyModel):
     """
-    クライアント側で生成した公開鍵をサーバに登録するエンドポイント。
+    クライアント側で生成した X25519 公開鍵をサーバに登録するエンドポイント。
     """
     client_id = data.clientId
-    public_key_pem = data.publicKeyPem
+    public_key_b64 = data.publicKeyRaw
 
-    if not public_key_pem:
+    if not public_key_b64:
         return {"error": "No public key provided"}
 
     try:
-        pubkey = serialization.load_pem_public_key(
-            public_key_pem.encode("utf-8"))
-        client_public_keys[client_id] = pubkey
+        pubkey = x25519.X25519PublicKey.from_public_bytes(
+            a2b_base64(public_key_b64))
+        _remember_client_key(client_id, pubkey)
         return {"status": "ok"}
     except Exception as e:
         return {"error": f"Failed to load public key: {e}"}
 
 
 @app.post("/upload-encrypted")
-def upload_encrypted(payload: EncryptedUploadModel):
+async def upload_encrypted(payload: EncryptedUploadModel):
     """
-    クライアントが暗号化した共通鍵とデータを送信してくるエンドポイント。
-    1. サーバは自身の秘密鍵で共通鍵を復号
-    2. 復号した共通鍵でデータを復号
+    クライアントが一時公開鍵と暗号化データを送信してくるエンドポイント。
+    1. サーバは自身の秘密鍵とクライアントの一時公開鍵の鍵共有で AES 鍵を導出
+    2. 導出した AES 鍵でデータを復号
     3. 復号データ（動画ファイル）をFFmpegでMP3に変換
-    4. 変換後のMP3データを新しいAES鍵で暗号化
-    5. 新しいAES鍵をクライアントの公開鍵で暗号化
-    6. 暗号化されたAES鍵と暗号化データを返す
+    4. サーバ側でも一時鍵ペアを生成し、クライアントの登録済み公開鍵と
+       鍵共有して応答用の AES 鍵を導出、MP3 データを暗号化
+    5. サーバの一時公開鍵と暗号化データを返す
     """
     client_id = payload.clientId
-    encrypted_key_b64 = payload.encryptedKey
+    ephemeral_pub_b64 = payload.ephemeralPubKey
     encrypted_data_b64 = payload.encryptedData
 
-    # クライアントIDチェック
-    if client_id not in client_public_keys:
+    # サイズ上限チェック。HTTP ボディ全体は limit_upload_size
+    # ミドルウェアがパース前に弾く。ここではバッチ経由 (ボディが
+    # 複数アイテムの合計になる) の個々のアイテムを base64 文字列長で
+    # 確認する
+    if len(encrypted_data_b64) > MAX_UPLOAD_BYTES * 4 // 3 + 4:
+        return {"error": "Payload too large"}
+
+    # クライアントIDチェック (以降はローカル参照で扱い、辞書には触らない)
+    client_pubkey = _lookup_client_key(client_id)
+    if client_pubkey is None:
         return {"error": f"clientId '{client_id}' not recognized. Please POST /client-public-key first."}
 
     # Base64 -> bytes
     try:
-        encrypted_key_bytes = base64.b64decode(encrypted_key_b64)
-        encrypted_data_bytes = base64.b64decode(encrypted_data_b64)
+        ephemeral_pub_bytes = a2b_base64(ephemeral_pub_b64)
+        encrypted_data_bytes = a2b_base64(encrypted_data_b64)
     except Exception as e:
         return {"error": f"Invalid Base64 data: {e}"}
 
-    # サーバ秘密鍵でAES鍵を復号
+    # クライアントの一時公開鍵と鍵共有して AES 鍵を導出
     try:
-        aes_key = decrypt_aes_key(encrypted_key_bytes)
+        client_ephemeral_pub = x25519.X25519PublicKey.from_public_bytes(
+            ephemeral_pub_bytes)
+        aes_key = derive_aes_key(server_private_key, client_ephemeral_pub)
     except Exception as e:
-        return {"error": f"Decryption of AES key failed: {e}"}
+        return {"error": f"Key agreement failed: {e}"}
 
     # AES鍵でデータを復号
     try:
-        # encrypted_data_bytes は Base64 デコード後の JSON 文字列
-        encrypted_data_json = encrypted_data_bytes.decode('utf-8')
-        encrypted_data = json.loads(encrypted_data_json)
-        nonce = base64.b64decode(encrypted_data['nonce'])
-        ciphertext = base64.b64decode(encrypted_data['ciphertext'])
-        tag = base64.b64decode(encrypted_data['tag'])
+        # encrypted_data_bytes は nonce(12) || ciphertext || tag(16) の
+        # バイナリ連結。bytes のスライスは切り出し分のコピーを作るので、
+        # 数十 MB になる ciphertext||tag は memoryview で参照だけ
+        # 切り出す。AEAD API はこの連結形式をそのまま受けるので、
+        # タグの分離もコピーも一切発生しない
+        if len(encrypted_data_bytes) < 28:
+            raise ValueError("encrypted data too short")
+        mv = memoryview(encrypted_data_bytes)
+        nonce = mv[:12]
+        ciphertext_with_tag = mv[12:]
     except Exception as e:
         return {"error": f"Parsing encrypted data failed: {e}"}
 
+    # AES の復号/暗号化は数十 MB で数十 ms かかる CPU 処理なので、
+    # スレッドプールに逃がしてイベントループをブロックしない
+    # (OpenSSL は AEAD 処理中 GIL を解放するので、スレッドで十分
+    # 並列化できる。ProcessPool だと巨大バッファの pickle 転送で
+    # かえって遅くなる)
+    loop = asyncio.get_running_loop()
     try:
-        plaintext = decrypt_data_aes(aes_key, nonce, ciphertext, tag)
+        plaintext = await loop.run_in_executor(
+            None, decrypt_data_aes, aes_key, nonce, ciphertext_with_tag)
     except Exception as e:
         return {"error": f"AES decryption failed: {e}"}
 
     # 取得したプレーンテキストが動画ファイルのバイナリデータと想定
-    input_path = ""
     try:
-        # 一時ファイルに書き出し
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
-            input_path = tmp.name
-            tmp.write(plaintext)
-
-        # FFmpegでMP3に変換
-        output_path = do_ffmpeg_convert_to_mp3(input_path)
-
-        # 変換後ファイルを読み込み
-        with open(output_path, "rb") as fin:
-            mp3_data = fin.read()
-
-        # 新しいAES鍵を生成
-        new_aes_key = os.urandom(32)  # 256ビットのAES鍵
-
-        # MP3データをAES-GCMで暗号化
-        encrypt_result = encrypt_data_aes(new_aes_key, mp3_data)
-
-        # 新しいAES鍵をクライアントの公開鍵で暗号化
-        client_pubkey = client_public_keys[client_id]
-        encrypted_new_aes_key = encrypt_aes_key(new_aes_key, client_pubkey)
-        encrypted_new_aes_key_b64 = base64.b64encode(
-            encrypted_new_aes_key).decode("utf-8")
-
-        # 暗号化データをJSON形式にまとめ、Base64エンコード
-        encrypted_data_to_send = json.dumps(encrypt_result)
-        encrypted_data_to_send_b64 = base64.b64encode(
-            encrypted_data_to_send.encode('utf-8')).decode('utf-8')
+        # 応答用の一時鍵ペアを生成し、クライアントの登録済み公開鍵と
+        # 鍵共有して新しい AES 鍵を導出する (鍵そのものは送らない)
+        server_ephemeral_priv = x25519.X25519PrivateKey.generate()
+        new_aes_key = derive_aes_key(server_ephemeral_priv, client_pubkey)
+
+        # FFmpegでMP3に変換しつつ、stdout をチャンク単位でそのまま
+        # AES-GCM 暗号化する (一時ファイル無し・MP3 平文の全体を
+        # メモリに持たない)
+        encrypt_result = await convert_to_mp3_encrypted(
+            plaintext, new_aes_key)
+
+        # クライアントへはサーバの一時公開鍵を渡す
+        server_ephemeral_pub_b64 = b2a_base64(
+            server_ephemeral_priv.public_key().public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw),
+            newline=False).decode('ascii')
+
+        # 暗号化データは base64 一段のみ (JSON ラップ無し)
+        # ascii デコードは utf-8 より速い (base64 出力は ASCII のみ)
+        encrypted_data_to_send_b64 = b2a_base64(
+            encrypt_result, newline=False).decode('ascii')
 
         # レスポンス
         return {
             "status": "ok",
-            "encryptedKey": encrypted_new_aes_key_b64,
+            "ephemeralPubKey": server_ephemeral_pub_b64,
             "encryptedResult": encrypted_data_to_send_b64
         }
 
     except Exception as e:
         return {"error": f"Processing error: {e}"}
-    finally:
-        # 後始末（入力ファイル）
-        if input_path and os.path.exists(input_path):
-            os.remove(input_path)
-        # 後始末（出力ファイル）
-        if "output_path" in locals() and output_path and os.path.exists(output_path):
-            os.remove(output_path)
+
+
+@app.post("/upload-encrypted-batch")
+async def upload_encrypted_batch(payload: BatchUploadModel):
+    """
+    複数の暗号化アップロードを 1 リクエストで処理するエンドポイント。
+    各アイテムは upload_encrypted と同じ処理を asyncio.gather で並行に
+    走らせる。AEAD の暗号化/復号はスレッドプール上で動き、OpenSSL は
+    ネイティブ処理中 GIL を解放するため、AES-NI のパイプラインが
+    コア数までスケールする。FastAPI のリクエストあたりのオーバー
+    ヘッドもバッチ全体で 1 回に償却される。
+    """
+    results = await asyncio.gather(
+        *(upload_encrypted(item) for item in payload.items))
+    return {"results": results}
 
 
 # ============================================================